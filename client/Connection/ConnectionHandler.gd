@@ -27,8 +27,14 @@ var Player = preload("res://Player/player.tscn")
 
 var players = {}
 
+# The join snapshot currently being received and the pages received from it
+var snapshot_id = 0
+var snapshot_pages = {}
+
 # The session id
 var session_id: String = ""
+# The compact connection handle, sent instead of the session id on frequent requests
+var conn: int = 0
 var user_name: String = ""
 var user_id: String = ""
 var player = null
@@ -49,6 +55,11 @@ var mutex: Mutex = null
 var message_queue: Array = []
 # Unused info queue, does nothing
 var chat_queue: Array = []
+# Fragments of large server messages by packet-id, only used by the receive thread
+var fragments: Dictionary = {}
+# Largest datagram sent before a request is split into fragments
+const MAX_DATAGRAM = 1200
+var fragment_id = 0
 
 var move_queue: Vector2 = Vector2.ZERO
 var vel_queue: Vector2 = Vector2.ZERO
@@ -60,6 +71,7 @@ var timer: Thread
 
 var chunk_width = 0
 var chunk_height = 0
+var tick_rate = 20
 
 var ChatHandler = null
 
@@ -98,52 +110,33 @@ func _process(_delta):
 			"error":
 				last_error_message = data.get("message")
 				show_popup("Error", data.get("message"))
+			"queued":
+				print("Waiting to log in, position %d in queue" % data.get("position"))
 			# TODO: write message response stuff
 			"message":
 				chat_queue.append([data.get("origin"), data.get("message")])
+			"messages":
+				for line in data.get("lines"):
+					chat_queue.append([line.get("origin"), line.get("message")])
 			"client-update":
-				var o_name = data.get("client-name")
-				var id = data.get("client-id")
-				if o_name.is_empty() or id.is_empty():# or id == user_id:
-					continue
-				var chunk_x = data.get("chunk-x")
-				var chunk_y = data.get("chunk-y")
-				var x = data.get("x") + (chunk_x * chunk_width)
-				var y = data.get("y") + (chunk_y * chunk_height)
-				if players.has(id):
-					players.get(id).teleport(Vector2(x, y))
-				else:
-					add_player(o_name, id)
-					var hold = players.get(id)
-					hold.teleport(Vector2(x, y))
-					if id == user_id:
-						create_player()
+				update_player(data.get("client-name"), data.get("client-id"),
+					data.get("chunk-x"), data.get("chunk-y"), data.get("x"), data.get("y"))
+			"snapshot-page":
+				for entry in data.get("clients"):
+					update_player(entry.get("name"), entry.get("id"),
+						entry.get("cx"), entry.get("cy"), entry.get("x"), entry.get("y"))
+				ack_snapshot_page(data)
 			"client-joined":
-				var o_name = data.get("client-name")
-				var id = data.get("client-id")
-				if o_name.is_empty() or id.is_empty():
-					continue
-				var tplayer = add_player(o_name, id)
-				var chunk_x = data.get("chunk-x")
-				var chunk_y = data.get("chunk-y")
-				var x = int(data.get("x")) 
-				var y = int(data.get("y"))
-				x += (chunk_x * chunk_width)
-				y += (chunk_y * chunk_height)
-				players.get(id).teleport(Vector2(x, y))
-				if id == user_id:
-					create_player()
-				if ChatHandler != null:
-					ChatHandler.player_joined(tplayer)
+				player_joined(data.get("client-name"), data.get("client-id"),
+					data.get("chunk-x"), data.get("chunk-y"), data.get("x"), data.get("y"))
 			"client-left":
-				var id = data.get("id")
-				if id != null and players.has(id):
-					#players[id].player_instance.queue_free()
-					print("leaving")
-					players[id].leave(get_node("/root/"))
-					if ChatHandler != null:
-						ChatHandler.player_left(players[id])
-					players.erase(id)
+				player_left(data.get("id"))
+			"presence":
+				for entry in data.get("joined"):
+					player_joined(entry.get("name"), entry.get("id"),
+						entry.get("cx"), entry.get("cy"), entry.get("x"), entry.get("y"))
+				for id in data.get("left"):
+					player_left(id)
 			"position-update":
 				var target = data.get("target")
 				if !players.has(target):
@@ -153,10 +146,11 @@ func _process(_delta):
 				var loc_y = (chunk_height * data.get("new-chunk-y")) + data.get("new-y")
 				
 				var pla = players.get(target)
-				var time = data.get("timestamp")
-				if pla.last_time < time:
-					pla.last_time = time
-					pla.teleport(Vector2(loc_x, loc_y))
+				var tick = data.get("tick")
+				if pla.last_time < tick:
+					pla.last_time = tick
+					pla.reckon(Vector2(loc_x, loc_y),
+						Vector2(data.get("vel-x"), data.get("vel-y")), tick_rate)
 				
 			# When a success response is recieved respond based on type
 			"success":
@@ -168,6 +162,7 @@ func _process(_delta):
 						getPlayers()
 						chunk_width = data.get("chunk-width")
 						chunk_height = data.get("chunk-height")
+						tick_rate = data.get("tick-rate", 20)
 						
 					# Shows a Success popup if type is register-success
 					"register-success":
@@ -233,6 +228,59 @@ func connect_udp(ip, port) -> Error:
 	#Returns OK
 	return OK
 
+## Teleports a known player or adds a new one
+func update_player(o_name, id, chunk_x, chunk_y, x, y):
+	if o_name == null or id == null or o_name.is_empty() or id.is_empty():
+		return
+	var pos = Vector2(x + (chunk_x * chunk_width), y + (chunk_y * chunk_height))
+	if players.has(id):
+		players.get(id).teleport(pos)
+	else:
+		add_player(o_name, id)
+		players.get(id).teleport(pos)
+		if id == user_id:
+			create_player()
+
+## Adds a player that joined the server
+func player_joined(o_name, id, chunk_x, chunk_y, x, y):
+	if o_name == null or id == null or o_name.is_empty() or id.is_empty():
+		return
+	var tplayer = add_player(o_name, id)
+	var pos = Vector2(int(x) + (chunk_x * chunk_width), int(y) + (chunk_y * chunk_height))
+	players.get(id).teleport(pos)
+	if id == user_id:
+		create_player()
+	if ChatHandler != null:
+		ChatHandler.player_joined(tplayer)
+
+## Removes a player that left the server
+func player_left(id):
+	if id != null and players.has(id):
+		#players[id].player_instance.queue_free()
+		print("leaving")
+		players[id].leave(get_node("/root/"))
+		if ChatHandler != null:
+			ChatHandler.player_left(players[id])
+		players.erase(id)
+
+## Acknowledges every page of a snapshot stream received so far
+func ack_snapshot_page(data: Dictionary):
+	var sid = int(data.get("snapshot"))
+	if sid != snapshot_id:
+		snapshot_id = sid
+		snapshot_pages = {}
+	snapshot_pages[int(data.get("page"))] = true
+	var count = 0
+	while snapshot_pages.has(count):
+		count += 1
+	var request = {
+		"request": "snapshot-ack",
+		"conn": conn,
+		"snapshot": snapshot_id,
+		"count": count
+	}
+	sendPacket(JSON.stringify(request))
+
 func add_player(o_name, id):
 	var fp = ForeignPlayer.new()
 	fp.create(get_node("/root"), o_name, id)
@@ -250,6 +298,7 @@ func load_public(data: Dictionary):
 ## Attempts to load session id from supplied Dictionary
 func load_session(data: Dictionary):
 	session_id = data.get("session")
+	conn = int(data.get("conn", 0))
 	user_name = data.get("name")
 	user_id = data.get("id")
 
@@ -319,7 +368,7 @@ func move():
 		return FAILED
 	var request = {
 		"request": "move",
-		"session-id": session_id,
+		"conn": conn,
 		"x": vel_queue.x,
 		"y": vel_queue.y,
 	}
@@ -338,7 +387,7 @@ func end_move():
 		return FAILED
 	var request = {
 		"request": "end-move",
-		"session-id": session_id
+		"conn": conn
 	}
 	move_queue = Vector2.ZERO
 	vel_queue = Vector2.ZERO
@@ -366,6 +415,7 @@ func logout():
 	#sends the packet to the server
 	sendPacket(to_send)
 	session_id = ""
+	conn = 0
 	user_name = ""
 	user_id = ""
 	
@@ -390,6 +440,13 @@ func _pull_information():
 			# Uses the JSON objects parse method to parse packet information and convert it into a Dictionary
 			var res = json.parse(packet.get_string_from_utf8())
 			
+			# Collects fragments until the whole message has arrived
+			if res == OK and json.data is Dictionary and json.data.get("response") == "fragment":
+				var data = reassemble(json.data)
+				if data == null:
+					continue
+				res = json.parse(data)
+
 			# If the result doesn't return an error
 			if res == OK:
 				# Locks the mutex
@@ -404,11 +461,43 @@ func _pull_information():
 	if !session_id.is_empty():
 		logout()
 
+## Adds a fragment and returns the whole message once every fragment arrived
+func reassemble(data: Dictionary):
+	var id = data.get("packet-id")
+	var count = int(data.get("count"))
+	if !fragments.has(id):
+		if fragments.size() >= 4:
+			fragments.erase(fragments.keys()[0])
+		fragments[id] = {}
+	fragments[id][int(data.get("index"))] = data.get("data")
+	if fragments[id].size() < count:
+		return null
+	var message = ""
+	for index in range(count):
+		message += fragments[id][index]
+	fragments.erase(id)
+	return message
+
 func sendPacket(message: String):
 	if WebSocketConnectionHandler.open:
 		WebSocketConnectionHandler.send(message.to_utf8_buffer())
 	elif UDP != null and UDP.is_socket_connected():
-		UDP.put_packet(message.to_utf8_buffer())
+		var buffer = message.to_utf8_buffer()
+		if buffer.size() <= MAX_DATAGRAM:
+			UDP.put_packet(buffer)
+			return
+		# Splits large requests into fragments the server reassembles
+		fragment_id += 1
+		var size = MAX_DATAGRAM / 2
+		var count = ceili(message.length() / float(size))
+		for index in range(count):
+			UDP.put_packet(JSON.stringify({
+				"request": "fragment",
+				"id": fragment_id,
+				"index": index,
+				"count": count,
+				"data": message.substr(index * size, size)
+			}).to_utf8_buffer())
 
 ## Attempts to send a message to the server
 func sendMessage(message):
@@ -416,7 +505,7 @@ func sendMessage(message):
 	var request = {
 		"request": "message",
 		"message": message,
-		"session-id": session_id
+		"conn": conn
 	}
 	
 	var to_send = JSON.stringify(request)
@@ -426,7 +515,7 @@ func getPlayers():
 	# Builds the message packet
 	var request = {
 		"request": "update",
-		"session-id": session_id
+		"conn": conn
 	}
 	
 	var to_send = JSON.stringify(request)
@@ -7,6 +7,11 @@ var player_id = ""
 var player_instance: Node
 var velocity = Vector2.ZERO
 var last_time = 0
+# Dead reckoning state from the last position update, velocity is per server tick
+var reckon_origin = Vector2.ZERO
+var reckon_velocity = Vector2.ZERO
+var reckon_start = 0
+var reckon_rate = 20
 
 func create(scene, n_name, id):
 	player_name = n_name
@@ -22,6 +27,9 @@ func create(scene, n_name, id):
 
 func _process(_delta):
 	if player_instance != null:
+		if reckon_velocity != Vector2.ZERO:
+			var ticks = (Time.get_ticks_msec() - reckon_start) * reckon_rate / 1000.0
+			player_instance.position = reckon_origin + reckon_velocity * ticks
 		player_instance.position += velocity
 	velocity = Vector2.ZERO
 
@@ -32,8 +40,17 @@ func move(vel):
 	velocity += vel
 
 func teleport(loc):
+	reckon_velocity = Vector2.ZERO
 	player_instance.position = loc
 
+## Places the player and extrapolates its position with vel until the next update
+func reckon(loc, vel, rate):
+	player_instance.position = loc
+	reckon_origin = loc
+	reckon_velocity = vel
+	reckon_start = Time.get_ticks_msec()
+	reckon_rate = rate
+
 func leave(current_scene):
 	current_scene.remove_child(self)
 	for child in player_instance.get_children():
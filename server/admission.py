@@ -0,0 +1,174 @@
+"""Login admission
+
+Runs password checks for logins and registrations on a fixed number of
+worker threads so bcrypt never runs on the receive thread, and keeps the
+requests waiting for a worker in a bounded FIFO queue.
+"""
+import threading
+import time
+import traceback
+from collections import OrderedDict
+
+from messagebuilder import build_message_generic
+from metrics import REGISTRY
+from tracing import TRACER
+
+
+class AdmissionQueue:
+    """AdmissionQueue class
+    FIFO queue of auth requests served by max_inflight AuthWorker threads
+
+    Each address holds at most one place in the queue per request type, a
+    repeated request replaces the queued one of the same type and keeps its
+    place. Requests from one address run one at a time in the order they were
+    queued, so a login waits for the registration sent before it. A request
+    repeated while the same type is being verified is answered with position
+    0. Queued clients are told their position when they join, when they repeat
+    a request and at most every progress_interval seconds while they wait.
+
+    Parameters:
+    server: ServerThread
+        The server whose handlers are run and whose relay sends responses
+    max_inflight: int
+        Requests verified at the same time
+    max_queue: int
+        Requests waiting before new ones are turned away
+    progress_interval: float
+        Seconds between position updates to waiting clients
+    """
+
+    def __init__(self, server, max_inflight: int = 2, max_queue: int = 256,
+                 progress_interval: float = 2.0):
+        self.server = server
+        self.max_queue = max_queue
+        self.progress_interval = progress_interval
+        self.last_progress = time.perf_counter()
+        self.waiting = OrderedDict()
+        self.inflight = {}
+        self.condition = threading.Condition()
+        self.running = True
+        self.queue_depth = REGISTRY.gauge("admission_queue_depth")
+        self.rejected = REGISTRY.counter_family("admission_rejected_total", "reason")
+        self.wait_time = REGISTRY.histogram("admission_wait_seconds")
+        self.workers = [AuthWorker(self, name=f"authworker{index}")
+                        for index in range(max_inflight)]
+
+    def submit(self, kind: str, data: dict, addr) -> bool:
+        """Queues an auth request
+        Returns False when it was turned away
+        Parameters:
+        kind: str
+            The request type, a key of the server's request handlers
+        data: dict
+            The decoded request
+        addr: pair(str, int)
+            Where the request came from
+        """
+        key = (addr, kind)
+        with self.condition:
+            if self.inflight.get(addr) == kind:
+                self.send_position(addr, kind, 0)
+                return False
+            if key in self.waiting:
+                (_, queued) = self.waiting[key]
+                self.waiting[key] = (data, queued)
+                self.send_position(addr, kind, list(self.waiting).index(key) + 1)
+                return True
+            if len(self.waiting) >= self.max_queue:
+                self.reject(addr, "queue-full", 'The login queue is full, try again later.')
+                return False
+            self.waiting[key] = (data, time.perf_counter())
+            self.queue_depth.set(len(self.waiting))
+            position = len(self.waiting)
+            if addr in self.inflight or position > len(self.workers) - len(self.inflight):
+                self.send_position(addr, kind, position)
+            self.condition.notify()
+            return True
+
+    def take(self):
+        """Waits for the next request and marks its address in flight
+        Returns None once stopped
+        """
+        with self.condition:
+            while self.running:
+                key = next((key for key in self.waiting if key[0] not in self.inflight), None)
+                if key is not None:
+                    break
+                self.condition.wait()
+            if not self.running:
+                return None
+            (addr, kind) = key
+            (data, queued) = self.waiting.pop(key)
+            self.inflight[addr] = kind
+            self.queue_depth.set(len(self.waiting))
+            self.wait_time.observe(time.perf_counter() - queued)
+            now = time.perf_counter()
+            if self.waiting and now - self.last_progress >= self.progress_interval:
+                self.last_progress = now
+                for (position, (waiting_addr, waiting_kind)) in enumerate(self.waiting, 1):
+                    self.send_position(waiting_addr, waiting_kind, position)
+            return (kind, data, addr)
+
+    def done(self, addr):
+        """Releases an address once its request has been handled
+        """
+        with self.condition:
+            self.inflight.pop(addr, None)
+            if self.waiting:
+                self.condition.notify()
+
+    def send_position(self, addr, kind: str, position: int):
+        """Tells a waiting client its place in the queue
+        """
+        self.server.message_handler.send_message(addr, {
+            "response": "queued",
+            "type": kind,
+            "position": position
+        }, 1, supersede=("queued", addr))
+
+    def reject(self, addr, reason: str, message: str):
+        """Turns a request away with an error
+        """
+        self.rejected.labels(reason).inc()
+        self.server.message_handler.send_message(
+            addr, build_message_generic("error", reason, message))
+
+    def stop(self):
+        """Stops the workers, queued requests are dropped
+        """
+        with self.condition:
+            self.running = False
+            self.waiting.clear()
+            self.condition.notify_all()
+
+
+class AuthWorker(threading.Thread):
+    """AuthWorker thread
+    Runs queued auth requests one at a time
+
+    Parameters:
+    admission: AdmissionQueue
+        The queue to take requests from
+    """
+
+    def __init__(self, admission: AdmissionQueue, name: str = "authworker"):
+        super(AuthWorker, self).__init__(name=name)
+        self.admission = admission
+        self.daemon = True
+        self.start()
+
+    def run(self):
+        while True:
+            job = self.admission.take()
+            if job is None:
+                return
+            (kind, data, addr) = job
+            try:
+                self.admission.server.auth_handlers[kind](data, addr)
+            except Exception as ex:  # a failed request must not stop the worker
+                print(f'Error handling {kind} from {addr}: {ex}')
+                TRACER.error(kind, addr, traceback.format_exc())
+                self.admission.server.message_handler.send_message(addr, build_message_generic(
+                    "error", "malformed-data", 'Supplied data was invalid.'))
+            finally:
+                self.admission.done(addr)
@@ -0,0 +1,389 @@
+"""Headless bot load generator and benchmark
+
+Drives simulated clients against a running server using the real protocol
+(obtain-public, register, init-session, update, snapshot-ack, move, end-move,
+message, confirm)
+and reports server tick time, server cpu, packet rates, retransmit rate and
+update latency.
+
+Start the server first then run ```python bench.py --clients 100 --duration 30```
+Use ```python bench.py --help``` for the movement and chat mix options.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import random
+import time
+
+import rsa
+
+try:
+    import websockets
+except ImportError:
+    websockets = None
+
+
+def percentile(values: list, pct: float):
+    """Returns the pct percentile of a list of values
+    Parameters:
+    values: list[float]
+        The values to use
+    pct: float
+        The percentile between 0 and 100
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class UdpProtocol(asyncio.DatagramProtocol):
+    """Forwards datagrams to a bot
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+
+    def datagram_received(self, data, addr):
+        self.bot.receive(data)
+
+
+class Bot:
+    """Bot class
+    A single simulated client
+
+    Parameters:
+    bench: Benchmark
+        The benchmark this bot reports to
+    name: str
+        The username to register and log in with
+    """
+
+    def __init__(self, bench, name: str):
+        self.bench = bench
+        self.name = name
+        self.transport = None
+        self.websocket = None
+        self.reader = None
+        self.waiters = []
+        self.session = None
+        self.conn = None
+        self.id = None
+        self.moving = False
+        self.move_sent = None
+        self.latencies = []
+        self.snapshot = None
+        self.snapshot_pages = set()
+
+    async def connect(self):
+        """Opens a UDP or WebSocket connection to the server
+        """
+        loop = asyncio.get_running_loop()
+        if self.bench.args.websocket:
+            self.websocket = await websockets.connect(
+                f'ws://{self.bench.args.host}:{self.bench.args.port}')
+            self.reader = asyncio.create_task(self.read_websocket())
+        else:
+            (self.transport, _) = await loop.create_datagram_endpoint(
+                lambda: UdpProtocol(self),
+                remote_addr=(self.bench.args.host, self.bench.args.port))
+
+    async def read_websocket(self):
+        """Reads messages from the WebSocket until it closes
+        """
+        try:
+            async for message in self.websocket:
+                self.receive(message)
+        except websockets.ConnectionClosed:
+            pass
+
+    def send(self, request: dict):
+        """Sends a request to the server
+        """
+        data = json.dumps(request).encode('utf-8')
+        self.bench.sent += 1
+        if self.websocket is not None:
+            asyncio.create_task(self.send_websocket(data))
+        else:
+            self.transport.sendto(data)
+
+    async def send_websocket(self, data: bytes):
+        """Sends on the WebSocket, ignoring sends racing a close
+        """
+        try:
+            await self.websocket.send(data)
+        except websockets.ConnectionClosed:
+            pass
+
+    def receive(self, data):
+        """Handles a packet from the server
+        """
+        self.bench.received += 1
+        try:
+            dat = json.loads(data)
+        except ValueError:
+            return
+        if 'packet-id' in dat:
+            self.send({"request": "confirm", "packet-id": dat['packet-id']})
+        if dat.get("response") == "snapshot-page":
+            self.ack_snapshot(dat)
+        if (dat.get("response") == "position-update" and self.move_sent is not None
+                and dat.get("target") == self.id):
+            self.latencies.append(time.perf_counter() - self.move_sent)
+            self.move_sent = None
+        for (check, future) in self.waiters:
+            if not future.done() and check(dat):
+                future.set_result(dat)
+
+    def ack_snapshot(self, dat: dict):
+        """Acknowledges the contiguous pages received of a join snapshot
+        """
+        if dat['snapshot'] != self.snapshot:
+            self.snapshot = dat['snapshot']
+            self.snapshot_pages = set()
+        self.snapshot_pages.add(dat['page'])
+        count = 0
+        while count in self.snapshot_pages:
+            count += 1
+        self.send(self.session_request(
+            {"request": "snapshot-ack", "snapshot": self.snapshot, "count": count}))
+
+    async def request(self, request: dict, check, retries: int = 3, timeout: float = 2.0):
+        """Sends a request and waits for a matching response
+        Resends on timeout since the transport may drop packets
+        Parameters:
+        request: dict
+            The request to send
+        check: Callable[[dict], bool]
+            Returns True for the expected response
+        """
+        future = asyncio.get_running_loop().create_future()
+        waiter = (check, future)
+        self.waiters.append(waiter)
+        try:
+            for _ in range(retries):
+                self.send(request)
+                try:
+                    return await asyncio.wait_for(asyncio.shield(future), timeout)
+                except asyncio.TimeoutError:
+                    continue
+            return None
+        finally:
+            self.waiters.remove(waiter)
+
+    async def login(self, password: str) -> bool:
+        """Obtains the public key, registers if needed and logs in
+        """
+        res = await self.request({"request": "obtain-public"},
+                                 lambda d: d.get("response") == "confirm-public")
+        if res is None:
+            return False
+        key = rsa.PublicKey.load_pkcs1(res['public-key'].encode('utf-8'))
+        encrypted = base64.b64encode(rsa.encrypt(password.encode('utf-8'), key)).decode('utf-8')
+
+        res = await self.request(
+            {"request": "register", "username": self.name, "password": encrypted},
+            lambda d: d.get("type") in ("register-success", "username-in-use", "queue-full"),
+            retries=10)
+        if res is None:
+            return False
+
+        res = await self.request(
+            {"request": "init-session", "username": self.name, "password": encrypted},
+            lambda d: d.get("type") in ("login-success", "invalid-info", "already-connected",
+                                        "server-full", "queue-full"), retries=10)
+        if res is None or res.get("type") != "login-success":
+            return False
+        self.session = res['session']
+        self.conn = res.get('conn')
+        self.id = res['id']
+        self.send(self.session_request({"request": "update"}))
+        return True
+
+    def session_request(self, request: dict) -> dict:
+        """Adds the session identifiers to a request
+        """
+        if self.conn is not None:
+            request["conn"] = self.conn
+        else:
+            request["session-id"] = self.session
+        return request
+
+    async def run(self, end: float, rng: random.Random):
+        """Sends moves and chat messages until the end time
+        Parameters:
+        end: float
+            perf_counter value to stop at
+        rng: Random
+            Random source for this bot
+        """
+        args = self.bench.args
+        rate = args.move_rate + args.chat_rate
+        if rate <= 0:
+            return
+        while time.perf_counter() < end:
+            await asyncio.sleep(min(rng.expovariate(rate), max(0.0, end - time.perf_counter())))
+            if time.perf_counter() >= end:
+                break
+            if rng.random() * rate < args.chat_rate:
+                self.send(self.session_request(
+                    {"request": "message", "channel": args.chat_channel,
+                     "message": f'bench message from {self.name}'}))
+            elif self.moving and rng.random() < args.stop_chance:
+                self.send(self.session_request({"request": "end-move"}))
+                self.moving = False
+            else:
+                self.send(self.session_request({
+                    "request": "move",
+                    "x": rng.choice((-1, 0, 1)) * args.speed,
+                    "y": rng.choice((-1, 0, 1)) * args.speed
+                }))
+                self.move_sent = time.perf_counter()
+                self.moving = True
+
+    async def logout(self):
+        """Ends the session and closes the connection
+        """
+        if self.session is not None:
+            await self.request({"request": "end-session", "session-id": self.session},
+                               lambda d: d.get("type") in ("logout-success",
+                                                           "user-not-connected"),
+                               retries=1, timeout=1.0)
+        if self.websocket is not None:
+            await self.websocket.close()
+            if self.reader is not None:
+                await self.reader
+        elif self.transport is not None:
+            self.transport.close()
+
+
+class Benchmark:
+    """Benchmark class
+    Runs a set of bots and collects the results
+
+    Parameters:
+    args: Namespace
+        Parsed command line arguments
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.sent = 0
+        self.received = 0
+        self.bots = []
+
+    async def server_stats(self, probe: Bot):
+        """Requests the raw server counters
+        """
+        return await probe.request({"request": "server-stats"},
+                                   lambda d: d.get("response") == "server-stats")
+
+    async def run(self) -> dict:
+        """Runs the whole benchmark and returns the results
+        """
+        args = self.args
+        rng = random.Random(args.seed)
+        probe = Bot(self, "probe")
+        await probe.connect()
+
+        self.bots = [Bot(self, f'{args.prefix}{i}') for i in range(args.clients)]
+        for bot in self.bots:
+            await bot.connect()
+        gate = asyncio.Semaphore(args.login_concurrency)
+
+        async def login(bot):
+            async with gate:
+                return await bot.login(args.password)
+
+        start = time.perf_counter()
+        logins = await asyncio.gather(*[login(bot) for bot in self.bots])
+        login_time = time.perf_counter() - start
+        active = [bot for (bot, ok) in zip(self.bots, logins) if ok]
+
+        before = await self.server_stats(probe)
+        (sent, received) = (self.sent, self.received)
+        start = time.perf_counter()
+        await asyncio.gather(*[bot.run(start + args.duration, random.Random(rng.random()))
+                               for bot in active])
+        elapsed = time.perf_counter() - start
+        after = await self.server_stats(probe)
+        (sent, received) = (self.sent - sent, self.received - received)
+
+        await asyncio.gather(*[bot.logout() for bot in self.bots])
+        await probe.logout()
+
+        latencies = [lat for bot in active for lat in bot.latencies]
+        results = {
+            "clients": args.clients,
+            "logged-in": len(active),
+            "login-time": login_time,
+            "duration": elapsed,
+            "client-packets-out/s": sent / elapsed,
+            "client-packets-in/s": received / elapsed,
+            "update-latency-p50-ms": percentile(latencies, 50) * 1000,
+            "update-latency-p99-ms": percentile(latencies, 99) * 1000,
+            "update-samples": len(latencies)
+        }
+        if before is not None and after is not None:
+            ticks = after['ticks'] - before['ticks']
+            packets_out = after['packets-out'] - before['packets-out']
+            results.update({
+                "tick-time-ms": ((after['tick-time'] - before['tick-time']) / ticks * 1000
+                                 if ticks else 0.0),
+                "server-cpu-%": (after['cpu'] - before['cpu']) / elapsed * 100,
+                "server-packets-in/s": (after['packets-in'] - before['packets-in']) / elapsed,
+                "server-packets-out/s": packets_out / elapsed,
+                "retransmit-rate": ((after['retransmits'] - before['retransmits']) / packets_out
+                                    if packets_out else 0.0)
+            })
+        return results
+
+
+def parse_args(argv=None):
+    """Parses command line arguments
+    """
+    parser = argparse.ArgumentParser(description="Club Cthulhu load generator")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=25555)
+    parser.add_argument("--clients", type=int, default=10, help="number of bots")
+    parser.add_argument("--login-concurrency", type=int, default=4,
+                        help="logins in flight at once")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to run")
+    parser.add_argument("--move-rate", type=float, default=2.0,
+                        help="movement requests per second per bot")
+    parser.add_argument("--stop-chance", type=float, default=0.3,
+                        help="chance a movement request stops a moving bot")
+    parser.add_argument("--chat-rate", type=float, default=0.05,
+                        help="chat messages per second per bot")
+    parser.add_argument("--chat-channel", default="global", choices=("global", "local"),
+                        help="channel bots chat on")
+    parser.add_argument("--speed", type=float, default=10.0, help="bot movement speed")
+    parser.add_argument("--prefix", default="benchbot", help="bot username prefix")
+    parser.add_argument("--password", default="Password")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--websocket", action="store_true",
+                        help="connect over WebSocket instead of UDP")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+    if args.websocket and websockets is None:
+        parser.error("--websocket requires the websockets module")
+    return args
+
+
+def main(argv=None):
+    """Runs the benchmark from the command line
+    """
+    args = parse_args(argv)
+    results = asyncio.run(Benchmark(args).run())
+    for (name, value) in results.items():
+        print(f'{name:>24}: {value:.3f}' if isinstance(value, float) else f'{name:>24}: {value}')
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,354 @@
+"""Packet capture and replay
+
+Captures inbound packets with arrival times and source addresses to a
+compact binary log and replays a log into a server instance through an
+in memory socket, either as fast as possible or at N times real speed.
+
+Capture files hold the server's private key so that replayed logins can be
+decrypted, treat them like the credentials they contain. A capture ends with
+a stats record holding the packets the live server sent while capturing, a
+replay reports its own count next to it.
+
+Replay a capture with ```python capture.py capture.bin --speed 1```
+"""
+import argparse
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+import rsa
+
+from clock import VirtualClock
+from metrics import REGISTRY
+
+MAGIC = b"CCAP"
+VERSION = 1
+HEADER = struct.Struct("<4sHI")
+RECORD = struct.Struct("<QBBHI")
+UDP = 0
+WEBSOCKET = 1
+STATS = 2
+
+
+class CaptureWriter:
+    """CaptureWriter class
+    Appends inbound packets to a capture file
+
+    Parameters:
+    path: str
+        The file to write
+    privatekey: rsa.PrivateKey
+        The server's private key, stored in the header for replays
+    """
+
+    def __init__(self, path: str, privatekey: rsa.PrivateKey):
+        self.path = path
+        self.lock = threading.Lock()
+        self.start = time.monotonic_ns()
+        self.count = 0
+        self.packets_out = REGISTRY.counter("packets_out_total")
+        self.packets_out_start = self.packets_out.value
+        key = privatekey.save_pkcs1()
+        # The header holds the private key, which decrypts the captured passwords
+        self.file = open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb")
+        os.fchmod(self.file.fileno(), 0o600)
+        self.file.write(HEADER.pack(MAGIC, VERSION, len(key)))
+        self.file.write(key)
+
+    def write(self, data, addr, transport: int = UDP):
+        """Records a single inbound packet
+        Parameters:
+        data: bytes or str
+            The packet as received
+        addr: pair(str, int)
+            The address it came from
+        transport: int
+            UDP or WEBSOCKET
+        """
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        try:
+            host = socket.inet_pton(socket.AF_INET, addr[0])
+        except OSError:
+            host = socket.inet_pton(socket.AF_INET6, addr[0])
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.write(RECORD.pack(time.monotonic_ns() - self.start, transport,
+                                        len(host), addr[1], len(data)))
+            self.file.write(host)
+            self.file.write(data)
+            self.count += 1
+
+    def close(self):
+        """Writes the stats record, flushes and closes the capture file
+        """
+        stats = json.dumps({"packets-out": self.packets_out.value - self.packets_out_start})
+        self.write(stats, ("0.0.0.0", 0), STATS)
+        with self.lock:
+            self.file.close()
+
+
+def read_capture(path: str):
+    """Reads a capture file
+    Returns the private key, a list of (time_ns, transport, addr, data) records
+    and the stats of the live run, empty for captures that were not closed
+    Parameters:
+    path: str
+        The file to read
+    """
+    records = []
+    stats = {}
+    with open(path, "rb") as file:
+        (magic, version, key_length) = HEADER.unpack(file.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{path} is not a version {VERSION} capture file')
+        privatekey = rsa.PrivateKey.load_pkcs1(file.read(key_length))
+        while head := file.read(RECORD.size):
+            if len(head) < RECORD.size:
+                break
+            (stamp, transport, host_length, port, length) = RECORD.unpack(head)
+            host = file.read(host_length)
+            family = socket.AF_INET if host_length == 4 else socket.AF_INET6
+            addr = (socket.inet_ntop(family, host), port)
+            data = file.read(length)
+            if transport == STATS:
+                stats = json.loads(data)
+                continue
+            records.append((stamp, transport, addr, data))
+    return privatekey, records, stats
+
+
+class ReplaySocket:
+    """ReplaySocket class
+    Stands in for the server's udp socket and plays back a capture
+
+    Sessions and connection handles in a capture belong to the original run, so
+    they are rewritten to the ones the replaying server handed to each address.
+    Packets after a login are held back until the server has answered it, so
+    the packets that depend on the session get the replay's session. A login
+    that is not answered within login_timeout seconds stops holding them.
+
+    Parameters:
+    records: list
+        Records from read_capture
+    speed: float
+        Playback speed multiplier, 0 delivers packets without waiting
+    clock: VirtualClock
+        Optional clock driven by the server, packets are delivered once it
+        reaches their captured time and it is held at the next packet's time
+    login_timeout: float
+        Seconds a login holds back the packets after it
+    """
+
+    def __init__(self, records: list, speed: float = 0.0, clock: VirtualClock = None,
+                 login_timeout: float = 10.0):
+        self.records = records
+        self.speed = speed
+        self.clock = clock
+        self.login_timeout = login_timeout
+        self.logins = {}
+        self.lock = threading.Lock()
+        self.index = 0
+        self.start = None
+        self.closed = False
+        self.finished = threading.Event()
+        self.sessions = {}
+        self.sent = 0
+        self.sent_bytes = 0
+        if clock is not None and records:
+            clock.hold(records[0][0] / 1e9)
+
+    def wait(self, timeout: float) -> bool:
+        """Stands in for select, waits until the next captured packet is due
+        """
+        if self.index >= len(self.records):
+            self.finished.set()
+            time.sleep(min(timeout, 0.05))
+            return False
+        if self.clock is not None:
+            self.clock.hold(self.records[self.index][0] / 1e9)
+            if self.due(self.index) > 0:
+                time.sleep(min(timeout, 0.001))
+                return False
+        if self.waiting_for_login():
+            time.sleep(min(timeout, 0.005))
+            return False
+        delay = self.due(self.index)
+        if delay > timeout:
+            time.sleep(timeout)
+            return False
+        if delay > 0:
+            time.sleep(delay)
+        return True
+
+    def due(self, index: int) -> float:
+        """Returns the seconds until a record is due, 0 when speed is not set
+        With a clock these are seconds of the clock
+        """
+        if self.clock is not None:
+            return (self.records[index][0] - self.clock.read_ns()) / 1e9
+        if self.speed <= 0:
+            return 0.0
+        stamp = self.records[index][0]
+        if self.start is None:
+            self.start = time.monotonic_ns() - stamp / self.speed
+        return (self.start + stamp / self.speed - time.monotonic_ns()) / 1e9
+
+    def recvfrom_into(self, buffer):
+        """Copies the next due captured packet into buffer
+        Raises BlockingIOError when no packet is due, like a non-blocking socket
+        """
+        if (self.index >= len(self.records) or self.waiting_for_login()
+                or self.due(self.index) > 0):
+            raise BlockingIOError()
+        (_, _, addr, data) = self.records[self.index]
+        self.index += 1
+        if b'"init-session"' in data:
+            with self.lock:
+                self.logins[addr] = time.monotonic() + self.login_timeout
+        data = self.rewrite(data, addr)
+        buffer[:len(data)] = data
+        return len(data), addr
+
+    def waiting_for_login(self) -> bool:
+        """Returns whether a delivered login has not been answered yet
+        """
+        with self.lock:
+            if not self.logins:
+                return False
+            now = time.monotonic()
+            for addr in [addr for (addr, deadline) in self.logins.items() if deadline < now]:
+                del self.logins[addr]
+            return bool(self.logins)
+
+    def rewrite(self, data: bytes, addr) -> bytes:
+        """Swaps captured session identifiers for the replay's
+        """
+        session = self.sessions.get(addr)
+        if session is None or (b'"session-id"' not in data and b'"conn"' not in data):
+            return data
+        try:
+            dat = json.loads(data)
+        except ValueError:
+            return data
+        if "session-id" in dat:
+            dat["session-id"] = session[0]
+        if "conn" in dat:
+            dat["conn"] = session[1]
+        return json.dumps(dat).encode('utf-8')
+
+    def sendto(self, data: bytes, addr):
+        """Counts an outbound packet and learns sessions from login responses
+        A login success or error releases the packets held back for the login
+        """
+        self.sent += 1
+        self.sent_bytes += len(data)
+        if b'"login-success"' in data:
+            dat = json.loads(data)
+            self.sessions[addr] = (dat.get("session"), dat.get("conn"))
+        if addr in self.logins and (b'"login-success"' in data or b'"error"' in data):
+            with self.lock:
+                self.logins.pop(addr, None)
+        return len(data)
+
+    def fileno(self):
+        """Returns -1 once closed like a real socket
+        """
+        return -1 if self.closed else 0
+
+    def close(self):
+        """Closes the socket
+        """
+        self.closed = True
+
+
+def replay(path: str, speed: float = 0.0, database: str = ":memory:", linger: float = 1.0):
+    """Replays a capture into a fresh server instance and returns its metrics
+    Parameters:
+    path: str
+        The capture to replay
+    speed: float
+        Playback speed multiplier, 0 delivers packets without waiting and runs
+        the server on a virtual clock that follows the captured times
+    database: str
+        The database to run against
+    linger: float
+        Seconds to keep the server running after the last packet
+    Returns the replay's results with live-packets-out from the capture when known
+    """
+    # websocketrelay imports server, importing it first resolves the cycle
+    import websocketrelay
+    from server import ServerThread
+
+    (privatekey, records, stats) = read_capture(path)
+    publickey = rsa.PublicKey(privatekey.n, privatekey.e)
+    clock = VirtualClock(epoch=time.time()) if speed <= 0 else None
+    sock = ReplaySocket(records, speed, clock)
+    cpu = time.process_time()
+    start = time.perf_counter()
+    server = ServerThread("", 0, sock=sock, database_path=database,
+                          keys=(publickey, privatekey), clock=clock, lockstep=clock is not None,
+                          interactive=False)
+    sock.finished.wait()
+    elapsed = time.perf_counter() - start
+    time.sleep(linger)
+    if clock is not None:
+        clock.hold(None)
+    server.close_server()
+    server.join()
+    results = {
+        "packets": len(records),
+        "duration": elapsed,
+        "cpu": time.process_time() - cpu,
+        "packets-out": REGISTRY.counter("packets_out_total").value,
+        "datagrams-out": sock.sent,
+        "bytes-out": sock.sent_bytes,
+        "metrics": REGISTRY.summary()
+    }
+    if "packets-out" in stats:
+        results["live-packets-out"] = stats["packets-out"]
+    return results
+
+
+def matches_live(results: dict, tolerance: float) -> bool:
+    """Returns whether a replay sent the packets the live run sent, within
+    tolerance as a fraction of the live count, True when the capture has no count
+    """
+    live = results.get("live-packets-out")
+    if live is None:
+        return True
+    return abs(results["packets-out"] - live) <= tolerance * max(live, 1)
+
+
+def main(argv=None):
+    """Replays a capture from the command line
+    """
+    parser = argparse.ArgumentParser(description="Replay a Club Cthulhu packet capture")
+    parser.add_argument("capture")
+    parser.add_argument("--speed", type=float, default=0.0,
+                        help="playback speed multiplier, 0 replays as fast as possible")
+    parser.add_argument("--database", default=":memory:",
+                        help="database to replay against, a copy is recommended")
+    parser.add_argument("--linger", type=float, default=1.0,
+                        help="seconds to keep simulating after the last packet")
+    parser.add_argument("--tolerance", type=float, default=0.05,
+                        help="largest difference from the live packets out, as a fraction")
+    args = parser.parse_args(argv)
+    results = replay(args.capture, args.speed, args.database, args.linger)
+    print(results.pop("metrics"))
+    for (name, value) in results.items():
+        print(f'{name:>16}: {value:.3f}' if isinstance(value, float) else f'{name:>16}: {value}')
+    if not matches_live(results, args.tolerance):
+        print(f'Replay sent {results["packets-out"]} packets, the live run sent '
+              f'{results["live-packets-out"]}')
+        return False
+    return True
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,109 @@
+"""Chat channel routing
+"""
+from metrics import REGISTRY
+
+CHANNELS = ("global", "local", "room")
+
+
+class ChatRouter:
+    """ChatRouter class
+    Fans chat lines out to channel subscribers and batches them per recipient
+    Only used from the world thread
+
+    Global lines go to every client in the world, local lines to clients within
+    local_radius chunks of the sender using the world's chunk occupancy and
+    room lines to the room's subscribers. Lines are collected per recipient and
+    sent as one messages response per recipient per tick.
+
+    Parameters:
+    world: World
+        The world whose clients and chunks are used
+    local_radius: int
+        Chunks around the sender that receive local lines
+    max_rooms: int
+        Rooms a single client can be subscribed to
+    """
+
+    def __init__(self, world, local_radius: int = 1, max_rooms: int = 8):
+        self.world = world
+        self.local_radius = local_radius
+        self.max_rooms = max_rooms
+        self.rooms = {}
+        self.client_rooms = {}
+        self.outbox = {}
+        self.fanout = REGISTRY.counter_family("chat_deliveries_total", "channel")
+
+    def join_room(self, client, room: str) -> bool:
+        """Subscribes a client to a room
+        """
+        joined = self.client_rooms.setdefault(client, set())
+        if room not in joined and len(joined) >= self.max_rooms:
+            return False
+        joined.add(room)
+        self.rooms.setdefault(room, set()).add(client)
+        return True
+
+    def leave_room(self, client, room: str):
+        """Unsubscribes a client from a room
+        """
+        self.client_rooms.get(client, set()).discard(room)
+        members = self.rooms.get(room)
+        if members is not None:
+            members.discard(client)
+            if not members:
+                del self.rooms[room]
+
+    def remove_client(self, client):
+        """Removes a client from every room and drops its pending lines
+        """
+        for room in self.client_rooms.pop(client, set()):
+            self.leave_room(client, room)
+        self.outbox.pop(client, None)
+
+    def recipients(self, sender, channel: str, room: str = None):
+        """Returns the clients that should receive a line
+        """
+        if channel == "global":
+            return self.world.clients.keys()
+        if channel == "room":
+            members = self.rooms.get(room, set())
+            return members if sender in members else ()
+        radius = self.local_radius
+        chunks = self.world.chunks
+        recipients = []
+        for y in range(max(0, sender.chunk_y - radius),
+                       min(self.world.height, sender.chunk_y + radius + 1)):
+            for x in range(max(0, sender.chunk_x - radius),
+                           min(self.world.width, sender.chunk_x + radius + 1)):
+                chunk = chunks.get((x, y))
+                if chunk is not None:
+                    recipients.extend(chunk.clients)
+        return recipients
+
+    def route(self, sender, channel: str, text: str, room: str = None):
+        """Queues a line for every recipient of its channel
+        """
+        line = {
+            "origin": str(sender.id),
+            "channel": channel,
+            "message": text
+        }
+        if room is not None:
+            line["room"] = room
+        recipients = self.recipients(sender, channel, room)
+        for client in recipients:
+            self.outbox.setdefault(client, []).append(line)
+        self.fanout.labels(channel).inc(len(recipients))
+
+    def flush(self):
+        """Sends each recipient its queued lines
+        """
+        if not self.outbox:
+            return
+        for (client, lines) in self.outbox.items():
+            for page in self.world.paginate(lines, {"response": "messages", "lines": []}):
+                self.world.message_handler.send_message(client.get_addr(), {
+                    "response": "messages",
+                    "lines": page
+                })
+        self.outbox.clear()
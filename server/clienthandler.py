@@ -2,14 +2,16 @@
 """
 
 from uuid import UUID
-from datetime import datetime, timedelta
 
 import json
 import secrets
+import sys
 import threading
 import time
 
 from math2 import Vector
+from tracing import TracedLock
+from clock import CLOCK
 
 
 class Client:
@@ -22,14 +24,21 @@ class Client:
         ID of the client, same as stored within the database
     name : str
         The clients name, pulled from the database and set upon registration
-    last_response: datetime
-        last timestamp when a message was recieved from this client
+    last_response: float
+        clock reading when a message was last recieved from this client
     addr : pair(str, int)
         The address from where the client sends messages from
+    conn : int
+        Compact connection handle assigned at login, 0 when not logged in
     chunk : Vector
         The current chunk th client is in
+        Stored as chunk_x and chunk_y
     pos : Vector
         The current position of the client, for game client use
+        Stored as x and y
+    vel : Vector
+        The current velocity of the client
+        Stored as vel_x and vel_y
     privilege_level : int
         The privilege level of a client
         Used for command executions
@@ -48,8 +57,11 @@ class Client:
     to_json:
         Quick way to convert to json
     """
+    __slots__ = ("id", "name", "last_response", "session", "_privilege_level", "addr",
+                 "conn", "x", "y", "chunk_x", "chunk_y", "vel_x", "vel_y", "color",
+                 "moving")
 
-    def __init__(self, cid: UUID,  name: str, last_response: datetime, addr=("", 0),
+    def __init__(self, cid: UUID,  name: str, last_response: float, addr=("", 0),
                  chunk: Vector = None, pos: Vector = None, privilege_level: int = 0,
                  color: int = (0,0,0)):
         self.id = cid
@@ -58,9 +70,11 @@ class Client:
         self.session = secrets.token_urlsafe(16)
         self._privilege_level = privilege_level
         self.addr = addr
-        self.pos = pos if pos is not None else [0, 0]
-        self.chunk = chunk if chunk is not None else [0, 0]
-        self.vel = [0, 0]
+        self.conn = 0
+        (self.x, self.y) = pos if pos is not None else (0, 0)
+        (self.chunk_x, self.chunk_y) = chunk if chunk is not None else (0, 0)
+        self.vel_x = 0
+        self.vel_y = 0
         self.color = color
         self.moving = False
 
@@ -74,7 +88,7 @@ class Client:
             the chunk to update using
         """
         # self.pos = [self.pos[0] + vel[0], self.pos[1] + vel[1]]
-        self.vel = vel
+        (self.vel_x, self.vel_y) = vel
 
     def teleport(self, vel: Vector, chunk):
         """Sets the current position to a vector
@@ -125,7 +139,40 @@ class Client:
         pos: Vector:
             Vector to use
         """
-        self.pos = pos
+        (self.x, self.y) = pos
+
+    @property
+    def pos(self):
+        """Returns the current position as a tuple
+        Prefer x and y in hot paths, this allocates
+        """
+        return (self.x, self.y)
+
+    @pos.setter
+    def pos(self, other):
+        (self.x, self.y) = other
+
+    @property
+    def chunk(self):
+        """Returns the current chunk as a tuple
+        Prefer chunk_x and chunk_y in hot paths, this allocates
+        """
+        return (self.chunk_x, self.chunk_y)
+
+    @chunk.setter
+    def chunk(self, other):
+        (self.chunk_x, self.chunk_y) = other
+
+    @property
+    def vel(self):
+        """Returns the current velocity as a tuple
+        Prefer vel_x and vel_y in hot paths, this allocates
+        """
+        return (self.vel_x, self.vel_y)
+
+    @vel.setter
+    def vel(self, other):
+        (self.vel_x, self.vel_y) = other
 
     @property
     def privilege_level(self):
@@ -148,7 +195,71 @@ class Client:
     def to_json(self):
         """Dumps self to json string
         """
-        return json.dumps(self.__dict__)
+        return json.dumps({
+            "id": str(self.id),
+            "name": self.name,
+            "addr": self.addr,
+            "chunk": self.chunk,
+            "pos": self.pos,
+            "vel": self.vel,
+            "color": self.color,
+            "moving": self.moving
+        })
+
+    def to_session(self) -> dict:
+        """Returns the state needed to restore this client's session after a restart
+        """
+        return {
+            "session": self.session,
+            "conn": self.conn,
+            "id": str(self.id),
+            "name": self.name,
+            "privilege": self._privilege_level,
+            "addr": list(self.addr),
+            "chunk": [self.chunk_x, self.chunk_y],
+            "pos": [self.x, self.y],
+            "color": list(self.color)
+        }
+
+    @classmethod
+    def from_session(cls, data: dict, now: float):
+        """Builds a client from a dict made by to_session
+        The client keeps its session id and its last response is set to now
+        Parameters:
+        data: dict
+            The saved session
+        now: float
+            The current clock reading
+        """
+        client = cls(UUID(data["id"]), data["name"], now, tuple(data["addr"]),
+                     tuple(data["chunk"]), tuple(data["pos"]), data["privilege"],
+                     tuple(data["color"]))
+        client.session = data["session"]
+        client.conn = data["conn"]
+        return client
+
+
+def client_footprint(client: Client) -> int:
+    """Returns the approximate number of bytes owned by a client instance
+    Counts the instance and the per client objects it references, shared
+    objects such as small ints and the color tuple default are skipped
+    Parameters:
+    client: Client
+        The client to measure
+    """
+    size = sys.getsizeof(client)
+    for value in (client.id, client.name, client.session, client.addr,
+                  client.last_response):
+        size += sys.getsizeof(value)
+    if isinstance(client.id, UUID):
+        size += sys.getsizeof(client.id.int)
+    if isinstance(client.addr, tuple):
+        size += sum(sys.getsizeof(v) for v in client.addr)
+    for value in (client.x, client.y, client.chunk_x, client.chunk_y,
+                  client.vel_x, client.vel_y, client.conn):
+        if not isinstance(value, int) or not -5 <= value <= 256:
+            size += sys.getsizeof(value)
+    return size
 
 
 class ClientThread(threading.Thread):
@@ -156,8 +267,10 @@ class ClientThread(threading.Thread):
     Handles all clients
 
     Parameters:
-    dc_time: timedelta Optional
-        The amount of time between responses before a client is kicked
+    dc_time: float Optional
+        The seconds between responses before a client is kicked
+    clock: Clock Optional
+        Sampled once per sweep over the clients
     clbk : func Optional
         Callback function to tell main thread information
     name : str Optional
@@ -170,6 +283,8 @@ class ClientThread(threading.Thread):
         Could be done on a timer in order to improve performance
     list_clients:
         Returns a string of all client names
+    memory_report:
+        Returns the measured memory use of connected clients
     send_message_to_all:
         sends a supplied message to all connected clients
     update_all:
@@ -185,8 +300,14 @@ class ClientThread(threading.Thread):
         adds a client to the client maps
     update_client_ts:
         updates the timestamp of specific client
-    update_client_bses_ts:
-        updates the timestamp of specific client using session as an indentifier 
+    resolve:
+        returns the client a packet belongs to using its connection handle or address
+    set_client_addr:
+        sets a client's address and updates the address index
+    export_sessions:
+        returns the saved state of every session
+    restore_sessions:
+        adds clients from saved sessions
     remove_client_ses:
         removes a client based on session
     remove_client:
@@ -198,17 +319,22 @@ class ClientThread(threading.Thread):
         ends the loop within run
     """
 
-    def __init__(self, server, dc_time=timedelta(minutes=5), clbk=None, name="clientthread"):
+    def __init__(self, server, dc_time=300.0, clbk=None, clock=CLOCK, name="clientthread"):
         super(ClientThread, self).__init__(name=name)
         self.clbk = clbk
         self.daemon = True
         self.dc_time = dc_time
+        self.clock = clock
         self.client_list = {}
         self.client_list_name = {}
         self.client_list_session = {}
-        self.lock = threading.RLock()
+        self.client_list_addr = {}
+        self.slots = []
+        self.free_slots = []
+        self.lock = TracedLock("clients")
         self.server = server
         self.running = True
+        self.kick_on_stop = True
         self.start()
 
     def run(self):
@@ -218,6 +344,8 @@ class ClientThread(threading.Thread):
         while self.running:
             self.update_all()
             time.sleep(0.0001)
+        if not self.kick_on_stop:
+            return
         with self.lock:
             for client in self.client_list.copy().values():
                 self.kick_client(client, "Server is closing.")
@@ -229,6 +357,23 @@ class ClientThread(threading.Thread):
         with self.lock:
             return {name: client.id for name, client in self.client_list_name.items()}
 
+    def memory_report(self) -> dict:
+        """Returns the measured memory use of all connected clients
+        Includes the per client share of the lookup maps
+        """
+        with self.lock:
+            count = len(self.client_list)
+            client_bytes = sum(client_footprint(c) for c in self.client_list.values())
+            index_bytes = (sys.getsizeof(self.client_list) + sys.getsizeof(self.client_list_name)
+                           + sys.getsizeof(self.client_list_session)
+                           + sys.getsizeof(self.client_list_addr) + sys.getsizeof(self.slots))
+        return {
+            "clients": count,
+            "client-bytes": client_bytes,
+            "index-bytes": index_bytes,
+            "bytes-per-player": (client_bytes + index_bytes) // count if count else 0
+        }
+
     def send_message_to_all(self, message, message_handler):
         """Sends the supplied message to all connected clients
         Parameters:
@@ -245,6 +390,7 @@ class ClientThread(threading.Thread):
         """Updates all connected clients
         """
         with self.lock:
+            self.clock.sample()
             for client in self.client_list.copy().values():
                 self.update_client(client)
 
@@ -255,10 +401,9 @@ class ClientThread(threading.Thread):
         client: Client
             Client to update
         """
-        if not isinstance(client.last_response, datetime):
+        if client.last_response is None:
             return
-        temp_time = datetime.now() - client.last_response
-        if temp_time > self.dc_time:
+        if self.clock.now() - client.last_response > self.dc_time:
             self.kick_client(client.name.lower(), "Session timed out.")
             return False
         return True
@@ -286,11 +431,14 @@ class ClientThread(threading.Thread):
         with self.lock:
             return self.client_list_session.get(session)
 
-    def add_client(self, client: Client) -> bool:
-        """ Adds a client instance to the maps and alerts all connected clients
+    def add_client(self, client: Client, position: tuple = None) -> bool:
+        """ Adds a client instance to the maps
+        The world announces the join with its next presence delta
         Parameters:
         client: Client
             The client to insert
+        position: tuple
+            Optional saved (chunk_x, chunk_y, x, y) to place the client at
         """
         with self.lock:
             if client.name.lower() in self.client_list_name:
@@ -298,19 +446,131 @@ class ClientThread(threading.Thread):
             self.client_list_name[client.name.lower()] = client
             self.client_list[client.id] = client
             self.client_list_session[client.get_session()] = client
-            self.server.world_handler.add_client(client)
-            self.send_message_to_all({
-                "response": "client-joined",
-                "client-name": client.name,
-                "client-id": str(client.id),
-                "x": client.pos[0],
-                "y": client.pos[1],
-                "chunk-x": client.chunk[0],
-                "chunk-y": client.chunk[1]
-            }, self.server.message_handler)
+            self.assign_slot(client)
+            self.server.world_handler.add_client(client, position)
             print(f'{client.name} joined.')
             return True
 
+    def export_sessions(self) -> list:
+        """Returns the saved state of every connected client
+        """
+        with self.lock:
+            return [client.to_session() for client in self.client_list.values()]
+
+    def restore_sessions(self, sessions: list) -> int:
+        """Adds clients from saved sessions so they can continue without logging in
+        Sessions keep their connection handle when its slot is free
+        Returns the number of restored clients
+        Parameters:
+        sessions: list[dict]
+            Sessions from export_sessions
+        """
+        restored = 0
+        with self.lock:
+            for data in sessions:
+                client = Client.from_session(data, self.clock.now())
+                if (client.name.lower() in self.client_list_name
+                        or client.session in self.client_list_session):
+                    continue
+                self.client_list_name[client.name.lower()] = client
+                self.client_list[client.id] = client
+                self.client_list_session[client.session] = client
+                self.client_list_addr[client.get_addr()] = client
+                self.restore_slot(client)
+                self.server.world_handler.add_client(
+                    client, (client.chunk_x, client.chunk_y, client.x, client.y))
+                restored += 1
+        return restored
+
+    def restore_slot(self, client: Client):
+        """Gives a restored client back its connection handle
+        Assigns a new handle if the slot is taken
+        Parameters:
+        client: Client
+            The client to place
+        """
+        with self.lock:
+            slot = client.conn >> 16
+            if client.conn <= 0 or slot >= 1 << 16:
+                self.assign_slot(client)
+                return
+            while len(self.slots) <= slot:
+                self.free_slots.append(len(self.slots))
+                self.slots.append(None)
+            if self.slots[slot] is not None:
+                self.assign_slot(client)
+                return
+            self.free_slots.remove(slot)
+            self.slots[slot] = client
+
+    def assign_slot(self, client: Client):
+        """Gives a client a compact connection handle
+        The handle is the slot index shifted left 16 bits with a random tag in the low bits
+        Parameters:
+        client: Client
+            The client to assign a slot to
+        """
+        with self.lock:
+            if self.free_slots:
+                slot = self.free_slots.pop()
+                self.slots[slot] = client
+            else:
+                slot = len(self.slots)
+                self.slots.append(client)
+            client.conn = (slot << 16) | (secrets.randbits(16) or 1)
+
+    def release_slot(self, client: Client):
+        """Frees the slot held by a client
+        Parameters:
+        client: Client
+            The client to release
+        """
+        with self.lock:
+            slot = client.conn >> 16
+            if client.conn and slot < len(self.slots) and self.slots[slot] is client:
+                self.slots[slot] = None
+                self.free_slots.append(slot)
+            client.conn = 0
+
+    def set_client_addr(self, client: Client, addr):
+        """Sets the address of a client and indexes it
+        Parameters:
+        client: Client
+            The client to update
+        addr: pair(str, int)
+            The new address
+        """
+        with self.lock:
+            if self.client_list_addr.get(client.get_addr()) is client:
+                self.client_list_addr.pop(client.get_addr(), None)
+            client.set_addr(addr)
+            self.client_list_addr[addr] = client
+
+    def resolve(self, data: dict, addr) -> Client:
+        """Returns the client a packet belongs to without waiting for a lock
+        Checks the address index first and falls back to the connection handle
+        Parameters:
+        data: dict
+            The decoded packet, must contain either conn or session-id
+        addr: pair(str, int)
+            The address the packet came from
+        """
+        conn = data.get("conn")
+        session = data.get("session-id")
+        client = self.client_list_addr.get(addr)
+        if client is not None and (client.conn == conn or client.session == session):
+            return client
+        if conn is not None:
+            slot = conn >> 16 if isinstance(conn, int) else -1
+            if 0 <= slot < len(self.slots):
+                client = self.slots[slot]
+                if client is not None and client.conn == conn:
+                    return client
+            return None
+        if session is not None:
+            return self.client_list_session.get(session)
+        return None
+
     def update_client_ts(self, data) -> bool:
         """Updates the last response timestamp of a client
         Parameters:
@@ -326,27 +586,13 @@ class ClientThread(threading.Thread):
             elif isinstance(data, UUID):
                 client = self.client_list.get(data)
             if client:
-                client.last_response = datetime.now()
+                client.last_response = self.clock.now()
                 return True
             return False
 
-    def update_client_bses_ts(self, session: str) -> bool:
-        """Updates the last response timestamp of a client
-        Based on the session id
-        Parameters:
-        session: str
-            the session id to lookup
-        """
-        with self.lock:
-            client = self.client_list_session.get(session)
-            if client is not None:
-                res = self.update_client_ts(client.name.lower())
-                return res
-            return False
-
     def remove_client_ses(self, session: str) -> bool:
         """Removes a client instance based on the session id
-        Sends a client-left packet to all connected clients
+        The world announces the leave with its next presence delta
         Parameters:
         session: str
             The session id of the client to kick
@@ -354,14 +600,14 @@ class ClientThread(threading.Thread):
         with self.lock:
             client = self.client_list_session.pop(session, None)
             if client:
-                self.send_message_to_all({
-                    "response": "client-left",
-                    "id": str(client.id)
-                }, self.server.message_handler)
                 name = client.name
                 self.client_list.pop(client.id, None)
                 self.client_list_name.pop(name.lower(), None)
+                if self.client_list_addr.get(client.get_addr()) is client:
+                    self.client_list_addr.pop(client.get_addr(), None)
+                self.release_slot(client)
                 self.server.world_handler.remove_client(client)
+                self.server.message_handler.purge(client.get_addr())
                 print(f'{name} left.')
             return True
 
@@ -393,12 +639,18 @@ class ClientThread(threading.Thread):
                 if isinstance(client, str):
                     client = self.client_list_name.get(client)
                 print(f"Kicking {client.name}")
+                self.remove_client(client.name.lower())
                 self.clbk('kick', {
                     'addr': client.get_addr(),
                     'message': message
                 })
-                self.remove_client(client.name.lower())
 
-    def stop(self):
-        """Stops the client thread"""
+    def stop(self, kick: bool = True):
+        """Stops the client thread
+        Parameters:
+        kick: bool
+            Whether connected clients are kicked, sessions that are handed to
+            the next run are not
+        """
+        self.kick_on_stop = kick
         self.running = False
@@ -0,0 +1,122 @@
+"""Shared monotonic clock
+
+The world, the message relay, the client handler and the receive loop read
+time from one Clock. Each loop samples it once per iteration and everything
+it calls reads the cached sample, so time is read once per tick or receive
+batch instead of once per message. Readings are monotonic, wall clock
+adjustments do not move deltas or timeouts.
+"""
+import threading
+import time
+
+
+class Clock:
+    """Clock class
+    Caches the last sample of the monotonic clock in seconds
+
+    The wall time of a sample is derived from the wall clock at creation so
+    timestamps sent to clients stay consistent with the monotonic readings.
+    Several threads sample the same clock, a reading older than the cached one
+    is discarded so the cached sample never goes backwards.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ns = self.read_ns()
+        self.epoch = time.time() - self.ns / 1e9
+
+    def read_ns(self) -> int:
+        """Reads the underlying clock in nanoseconds
+        """
+        return time.monotonic_ns()
+
+    def sample(self) -> float:
+        """Reads the clock, caches and returns the latest sample in seconds
+        """
+        reading = self.read_ns()
+        with self.lock:
+            if reading > self.ns:
+                self.ns = reading
+            return self.ns / 1e9
+
+    def now(self) -> float:
+        """Returns the last sample in seconds without reading the clock
+        """
+        return self.ns / 1e9
+
+    def wall(self) -> float:
+        """Returns the last sample as a unix timestamp
+        """
+        return self.epoch + self.ns / 1e9
+
+    def sleep(self, seconds: float):
+        """Waits for seconds to pass
+        """
+        time.sleep(seconds)
+
+    def wait(self, event: threading.Event, timeout: float) -> bool:
+        """Waits up to timeout seconds for event, returns whether it was set
+        """
+        return event.wait(timeout)
+
+
+class VirtualClock(Clock):
+    """VirtualClock class
+    Clock that only moves when advanced, for tests and replays
+
+    Sleeping and waiting advance the clock instead of waiting for real time.
+    A replay holds the clock at the time of its next packet, sleepers that
+    would pass the hold move the clock up to it and wait in real time until
+    it is moved or lifted.
+
+    Parameters:
+    start: float
+        The first reading in seconds
+    epoch: float
+        The unix timestamp of reading 0
+    """
+
+    def __init__(self, start: float = 0.0, epoch: float = 0.0):
+        self.virtual_ns = int(start * 1e9)
+        self.hold_ns = None
+        super(VirtualClock, self).__init__()
+        self.epoch = epoch
+
+    def read_ns(self) -> int:
+        return self.virtual_ns
+
+    def advance(self, seconds: float):
+        """Moves the clock forward, the next sample sees the new time
+        """
+        self.virtual_ns += int(seconds * 1e9)
+
+    def advance_to(self, seconds: float):
+        """Moves the clock forward to a reading, earlier readings are ignored
+        """
+        self.virtual_ns = max(self.virtual_ns, int(seconds * 1e9))
+
+    def hold(self, seconds):
+        """Keeps sleepers from moving the clock past seconds, None lifts the hold
+        """
+        self.hold_ns = None if seconds is None else round(seconds * 1e9)
+
+    def sleep(self, seconds: float):
+        self.wait(None, seconds)
+
+    def wait(self, event: threading.Event, timeout: float) -> bool:
+        target = self.virtual_ns + int(timeout * 1e9)
+        while event is None or not event.is_set():
+            hold = self.hold_ns
+            with self.lock:
+                if hold is None or hold >= target:
+                    self.virtual_ns = max(self.virtual_ns, target)
+                    return False
+                self.virtual_ns = max(self.virtual_ns, hold)
+            if event is None:
+                time.sleep(0.001)
+            else:
+                event.wait(0.001)
+        return True
+
+
+CLOCK = Clock()
@@ -0,0 +1,146 @@
+"""Datagram fragmentation
+
+Splits payloads that do not fit in one datagram into numbered JSON fragments
+and reassembles the fragments clients send back into the original payload.
+"""
+import json
+import threading
+
+from clock import CLOCK
+from metrics import REGISTRY
+
+MAX_DATAGRAM = 1200
+FRAGMENT_OVERHEAD = 64
+
+
+def fragment(payload: str, packet_id: str, max_datagram: int = MAX_DATAGRAM) -> list:
+    """Splits a json payload into fragment datagrams of at most max_datagram bytes
+    Each fragment is a fragment response carrying a slice of the payload
+    Parameters:
+    payload: str
+        The encoded message
+    packet_id: str
+        The packet id of the message, shared by its fragments
+    max_datagram: int
+        Largest datagram to produce
+    """
+    # Escaping can only grow a slice, the count and index digits are reserved up front
+    header = len(json.dumps({"response": "fragment", "packet-id": packet_id,
+                             "index": 99999, "count": 99999, "data": ""}))
+    budget = max_datagram - header
+    if budget < 64:
+        raise ValueError(f'max_datagram {max_datagram} leaves no room for data')
+    slices = []
+    start = 0
+    while start < len(payload):
+        end = min(len(payload), start + budget)
+        while len(json.dumps(payload[start:end])) - 2 > budget:
+            end -= max(1, (len(json.dumps(payload[start:end])) - 2 - budget) // 2)
+        slices.append(payload[start:end])
+        start = end
+    return [json.dumps({
+        "response": "fragment",
+        "packet-id": packet_id,
+        "index": index,
+        "count": len(slices),
+        "data": data
+    }).encode('utf-8') for (index, data) in enumerate(slices)]
+
+
+class Reassembler:
+    """Reassembler class
+    Collects fragments from clients until a payload is complete
+    Safe to use from the udp and websocket threads
+
+    Each address may have max_messages partial payloads of at most max_bytes
+    in at most max_fragments fragments, starting another drops its oldest one.
+    Every fragment counts FRAGMENT_OVERHEAD bytes toward max_bytes on top of
+    its data. Partial payloads are dropped when their last fragment is older
+    than timeout seconds.
+
+    Parameters:
+    max_bytes: int
+        Largest payload that is reassembled, counting FRAGMENT_OVERHEAD per fragment
+    max_fragments: int
+        Most fragments a payload may be split into
+    max_messages: int
+        Partial payloads kept per address
+    timeout: float
+        Seconds a partial payload waits for its next fragment
+    clock: Clock
+        Read for fragment times, sampled by the receive loop
+    """
+
+    def __init__(self, max_bytes: int = 65536, max_fragments: int = 128, max_messages: int = 4,
+                 timeout: float = 5.0, clock=CLOCK):
+        self.max_bytes = max_bytes
+        self.max_fragments = max_fragments
+        self.max_messages = max_messages
+        self.timeout = timeout
+        self.partial = {}
+        self.lock = threading.Lock()
+        self.clock = clock
+        self.next_purge = clock.now() + timeout
+        self.completed = REGISTRY.counter("fragments_reassembled_total")
+        self.dropped = REGISTRY.counter_family("fragments_dropped_total", "reason")
+
+    def add(self, addr, data: dict):
+        """Adds a fragment and returns the payload once all of its fragments arrived
+        Returns None while fragments are missing or when the fragment is dropped
+        Parameters:
+        addr: pair(str, int)
+            Where the fragment came from
+        data: dict
+            The fragment request with id, index, count and data
+        """
+        (mid, index, count, chunk) = (data["id"], data["index"], data["count"], data["data"])
+        if (not isinstance(index, int) or not isinstance(count, int) or not isinstance(chunk, str)
+                or not 0 <= index < count or isinstance(mid, (dict, list))):
+            self.dropped.labels("invalid").inc()
+            return None
+        if count > self.max_fragments:
+            self.dropped.labels("too-large").inc()
+            return None
+        now = self.clock.now()
+        with self.lock:
+            if now >= self.next_purge:
+                self.purge(now)
+            messages = self.partial.setdefault(addr, {})
+            message = messages.get(mid)
+            if message is None:
+                if len(messages) >= self.max_messages:
+                    messages.pop(next(iter(messages)))
+                    self.dropped.labels("overflow").inc()
+                message = messages[mid] = [count, {}, 0, now]
+            if message[0] != count:
+                self.dropped.labels("invalid").inc()
+                return None
+            if index not in message[1]:
+                message[2] += len(chunk) + FRAGMENT_OVERHEAD
+                message[1][index] = chunk
+            message[3] = now
+            if message[2] > self.max_bytes:
+                del messages[mid]
+                self.dropped.labels("too-large").inc()
+                return None
+            if len(message[1]) < count:
+                return None
+            del messages[mid]
+            if not messages:
+                del self.partial[addr]
+        self.completed.inc()
+        return "".join(message[1][part] for part in range(count)).encode('utf-8')
+
+    def purge(self, now: float):
+        """Drops partial payloads that timed out
+        Called with the lock held
+        """
+        self.next_purge = now + self.timeout
+        for addr in list(self.partial):
+            messages = self.partial[addr]
+            for mid in [mid for (mid, message) in messages.items()
+                        if now - message[3] > self.timeout]:
+                del messages[mid]
+                self.dropped.labels("timeout").inc()
+            if not messages:
+                del self.partial[addr]
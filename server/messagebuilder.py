@@ -2,23 +2,32 @@
 """
 import json
 import traceback
-import time
-import asyncio
-from uuid import uuid4
-from threading import Thread, RLock
-from datetime import datetime, timedelta
+from collections import deque
+from uuid import UUID, uuid4
+from threading import Event, Lock, Thread
+from clock import CLOCK
 from utils import Timer
+from metrics import REGISTRY
+from tracing import TracedLock
+from fragments import MAX_DATAGRAM, fragment
+
+# Bytes send_message adds to a message, the timestamp is given room for any float
+RELIABLE_OVERHEAD = len(json.dumps({"packet-id": str(UUID(int=0)), "timestamp": 0})) + 24
 
 
 class Message:
     """Message container class
     """
 
-    def __init__(self, message, addr, retry, retry_int):
+    def __init__(self, message, addr, retry, retry_int, supersede=None):
         self.message = message
         self.addr = addr
         self.retry = retry
         self.retry_int = retry_int
+        self.supersede = supersede
+        self.sent = False
+        self.fragments = None
+        self.size = len(message)
 
 
 def build_message_generic(name, msg_type, message):
@@ -34,36 +43,99 @@ def build_message_generic(name, msg_type, message):
 
 class MessageRelay(Thread):
     """MessageRelay class
+    Messages too large for one udp datagram are sent as numbered fragments
+    that share the message's packet id, WebSocket clients get them whole
+
+    Due datagrams are queued in the outbox while the lock is held and sent
+    by flush outside of it on the non-blocking server socket. A flush runs
+    when the world ends a tick, when the server finishes a receive batch,
+    when flush_threshold messages were queued or every interval seconds.
+    Datagrams the socket can not take yet stay queued for the next flush.
+
+    Waiting messages are capped in bytes per destination and in total. A
+    message with a supersede key replaces the waiting one with the same key
+    and address. When a cap is hit the "superseded" policy drops messages
+    that carry a supersede key before the oldest ones, the "oldest" policy
+    drops the oldest. Messages to a client are purged when its session ends.
+
+    Parameters:
+    sock: socket
+        The server's non-blocking udp socket
+    flush_threshold: int
+        Queued messages that trigger a flush before the next tick
+    interval: float
+        Longest wait between flushes, retries are checked as often
+    max_bytes: int
+        Bytes of waiting messages kept in total
+    max_addr_bytes: int
+        Bytes of waiting messages kept per destination
+    drop_policy: str
+        "superseded" or "oldest"
+    clock: Clock
+        Sampled once per loop, message timestamps use the latest sample
+    lockstep: bool
+        Send on the thread that requests a flush instead of waking the relay,
+        replays use it so output keeps pace with a virtual clock
     """
     max_retries = 1
-    retry_interval = timedelta(milliseconds=500)
-    waiting = {}
-    to_remove = []
-    lock = RLock()
-    running = True
+    retry_interval = 0.5
 
-    def __init__(self, sock, websocket_relay = None, clbk=None,  name='MessageThread'):
+    def __init__(self, sock, websocket_relay = None, clbk=None, flush_threshold=256,
+                 interval=0.01, max_bytes=16 * 1024 * 1024, max_addr_bytes=256 * 1024,
+                 drop_policy="superseded", clock=CLOCK, lockstep=False,
+                 name='MessageThread'):
         super(MessageRelay, self).__init__(name=name)
+        if drop_policy not in ("superseded", "oldest"):
+            raise ValueError(f'Unknown drop policy {drop_policy}')
         self.clbk = clbk
         self.daemon = True
+        self.waiting = {}
+        self.to_remove = []
+        self.lock = TracedLock("relay")
+        self.running = True
+        self.max_bytes = max_bytes
+        self.max_addr_bytes = max_addr_bytes
+        self.drop_policy = drop_policy
+        self.by_addr = {}
+        self.addr_bytes = {}
+        self.total_bytes = 0
+        self.replaceable = {}
+        self.superseding = {}
         self.websocket_relay = websocket_relay
-        self.sock = sock.dup()
-        self.timer = Timer()
+        self.sock = sock
+        self.clock = clock
+        self.timer = Timer(clock)
         self.delta = 0
+        self.flush_threshold = flush_threshold
+        self.interval = interval
+        self.outbox = deque()
+        self.queued = 0
+        self.wakeup = Event()
+        self.lockstep = lockstep
+        self.flush_lock = Lock()
+        self.packets_sent = REGISTRY.counter("packets_out_total")
+        self.packets_resent = REGISTRY.counter("retransmits_total")
+        self.fragments_sent = REGISTRY.counter("fragments_sent_total")
+        self.queue_depth = REGISTRY.gauge("reliable_queue_depth")
+        self.queue_bytes = REGISTRY.gauge("reliable_queue_bytes")
+        self.dropped = REGISTRY.counter_family("reliable_dropped_total", "reason")
+        self.flushes = REGISTRY.counter("send_flushes_total")
+        self.deferred = REGISTRY.counter("send_deferred_total")
+        self.backlog = REGISTRY.gauge("send_backlog")
         self.start()
 
     def run(self):
         print("Starting Message Handler...")
         while self.running:
             try:
-                self.delta = self.timer.get_delta()
-                if len(self.waiting) > 0:
-                    self.update(self.delta)
+                self.wakeup.wait(self.interval)
+                self.wakeup.clear()
+                self.pump()
             except IOError as e:
                 print(f'Error in Message Handler: {e}')
                 print(traceback.format_exc())
+        self.flush()
         self.stop()
-        self.sock.close()
 
     def get_waiting(self):
         """Returns the messages waiting to be sent
@@ -71,18 +143,148 @@ class MessageRelay(Thread):
         with self.lock:
             return self.waiting.copy()
 
-    def send_message(self, addr, message, retries=max_retries):
+    def send_message(self, addr, message, retries=max_retries, supersede=None):
         """ Adds a message to the delivery queue
+        supersede: Any
+            Optional key, a newer message with the same key and address
+            replaces this one where the transport queues messages
         """
         with self.lock:
             packet_id = uuid4()
             message['packet-id'] = str(packet_id)
-            message['timestamp'] = datetime.now().timestamp()
+            message['timestamp'] = self.clock.wall()
             to_send = json.dumps(message)
-            self.waiting[packet_id] = Message(
-                to_send, addr, retries, self.retry_interval)
+            self.enqueue_no_lock(packet_id, Message(
+                to_send, addr, retries, self.retry_interval, supersede))
+            self.queued += 1
+            if self.queued >= self.flush_threshold:
+                self.wakeup.set()
             return message
 
+    def enqueue_no_lock(self, mid, msg: Message):
+        """Adds a message to the waiting messages and enforces the caps
+        Called with the lock held
+        A message larger than max_addr_bytes is dropped without evicting others
+        """
+        if msg.size > self.max_addr_bytes or msg.size > self.max_bytes:
+            self.dropped.labels("too-large").inc()
+            return
+        if msg.supersede is not None:
+            old = self.superseding.get((msg.addr, msg.supersede))
+            if old is not None:
+                self.discard_no_lock(old, "superseded")
+            self.superseding[(msg.addr, msg.supersede)] = mid
+            self.replaceable[mid] = None
+        self.waiting[mid] = msg
+        self.by_addr.setdefault(msg.addr, {})[mid] = None
+        self.addr_bytes[msg.addr] = self.addr_bytes.get(msg.addr, 0) + msg.size
+        self.total_bytes += msg.size
+        while self.addr_bytes.get(msg.addr, 0) > self.max_addr_bytes:
+            self.discard_no_lock(self.victim(self.by_addr[msg.addr]), "addr-cap")
+        while self.total_bytes > self.max_bytes:
+            self.discard_no_lock(self.victim(self.waiting), "global-cap")
+
+    def victim(self, mids) -> UUID:
+        """Returns the message the drop policy gives up first among mids
+        Parameters:
+        mids: dict
+            Message ids in the order they were queued
+        """
+        if self.drop_policy == "superseded":
+            if mids is self.waiting:
+                if self.replaceable:
+                    return next(iter(self.replaceable))
+            else:
+                for mid in mids:
+                    if mid in self.replaceable:
+                        return mid
+        return next(iter(mids))
+
+    def discard_no_lock(self, mid, reason=None):
+        """Removes a waiting message, reason is counted when it was dropped undelivered
+        Called with the lock held
+        """
+        msg = self.waiting.pop(mid, None)
+        if msg is None:
+            return
+        if reason is not None:
+            self.dropped.labels(reason).inc()
+        mids = self.by_addr[msg.addr]
+        del mids[mid]
+        if mids:
+            self.addr_bytes[msg.addr] -= msg.size
+        else:
+            del self.by_addr[msg.addr]
+            del self.addr_bytes[msg.addr]
+        self.total_bytes -= msg.size
+        if msg.supersede is not None:
+            self.replaceable.pop(mid, None)
+            if self.superseding.get((msg.addr, msg.supersede)) == mid:
+                del self.superseding[(msg.addr, msg.supersede)]
+
+    def purge(self, addr):
+        """Drops every waiting message to an address, called when its session ends
+        Parameters:
+        addr: pair(str, int)
+            The address of the client that left
+        """
+        with self.lock:
+            for mid in list(self.by_addr.get(addr, ())):
+                self.discard_no_lock(mid, "session-ended")
+            self.queue_depth.set(len(self.waiting))
+            self.queue_bytes.set(self.total_bytes)
+
+    def send_datagram(self, data: bytes, addr):
+        """Queues an unreliable datagram for the next flush
+        Parameters:
+        data: bytes
+            The encoded datagram
+        addr: pair(str, int)
+            Where to send it
+        """
+        self.outbox.append((data, addr))
+        if len(self.outbox) >= self.flush_threshold:
+            self.wakeup.set()
+
+    def request_flush(self):
+        """Wakes the relay to send what is queued, called at the end of a tick
+        In lockstep the queue is sent before returning
+        """
+        if self.lockstep:
+            self.pump()
+        else:
+            self.wakeup.set()
+
+    def pump(self):
+        """Queues the messages that are due and flushes them
+        """
+        with self.flush_lock:
+            self.delta = self.timer.get_delta()
+            if len(self.waiting) > 0:
+                self.update(self.delta)
+            self.flush()
+
+    def flush(self):
+        """Sends queued datagrams until the outbox is empty or the socket would block
+        Called from pump or once the relay stopped
+        """
+        self.queued = 0
+        if not self.outbox:
+            return
+        self.flushes.inc()
+        while self.outbox:
+            (data, addr) = self.outbox[0]
+            try:
+                self.sock.sendto(data, addr)
+            except (BlockingIOError, InterruptedError):
+                self.deferred.inc()
+                break
+            except OSError as ex:
+                if self.running:
+                    print(f'Error sending to {addr}: {ex}')
+            self.outbox.popleft()
+        self.backlog.set(len(self.outbox))
+
     def update(self, delta):
         """ Empties the queue
         """
@@ -92,9 +294,10 @@ class MessageRelay(Thread):
                     self.resend_message_no_lock(key[0])
                 key[1].retry_int = key[1].retry_int + delta
             for mid in self.to_remove:
-                self.waiting.pop(mid, None)
+                self.discard_no_lock(mid)
             self.to_remove.clear()
-            time.sleep(0)
+            self.queue_depth.set(len(self.waiting))
+            self.queue_bytes.set(self.total_bytes)
 
     def resend_message_no_lock(self, mid) -> bool:
         """Attempts to resend a message without using a lock
@@ -104,15 +307,23 @@ class MessageRelay(Thread):
         if self.waiting.get(mid).retry < 1 or not self.waiting.get(mid).addr[0]:
             self.to_remove.append(mid)
             return False
-        self.waiting.get(mid).retry_int = timedelta(seconds=0)
+        msg = self.waiting.get(mid)
+        if msg.sent:
+            self.packets_resent.inc()
+        msg.sent = True
+        self.packets_sent.inc()
+        self.waiting.get(mid).retry_int = 0.0
         self.waiting.get(mid).retry -= 1
-        if self.websocket_relay is not None and self.waiting.get(mid).addr in self.websocket_relay.clients:
-            msg = self.waiting.get(mid)
-            asyncio.run(self.websocket_relay.clients.get(msg.addr).send(msg.message.encode(
-                'utf-8')))
+        if self.websocket_relay is not None and msg.addr in self.websocket_relay.clients:
+            self.websocket_relay.send(msg.addr, msg.message.encode('utf-8'), msg.supersede)
+        elif len(msg.message) > MAX_DATAGRAM:
+            if msg.fragments is None:
+                msg.fragments = fragment(msg.message, str(mid))
+            for datagram in msg.fragments:
+                self.outbox.append((datagram, msg.addr))
+            self.fragments_sent.inc(len(msg.fragments))
         else:
-            self.sock.sendto(self.waiting[mid].message.encode(
-                'utf-8'), self.waiting[mid].addr)
+            self.outbox.append((msg.message.encode('utf-8'), msg.addr))
 
     @staticmethod
     def send_message_async(sock, message):
@@ -123,7 +334,7 @@ class MessageRelay(Thread):
             return None
         if message[1].retry < 1:
             return message[0], None
-        message[1].retry_int = timedelta(seconds=0)
+        message[1].retry_int = 0.0
         message[1].retry -= 1
         try:
             sock.sendto(message[1].message.encode('utf-8'), message[1].addr)
@@ -142,7 +353,7 @@ class MessageRelay(Thread):
             self.waiting[result[0]] = result[1]
         else:
             print(result)
-            self.waiting.pop(result[0], None)
+            self.discard_no_lock(result[0])
             print(self.waiting)
 
     def resend_message(self, mid) -> bool:
@@ -0,0 +1,304 @@
+"""Runtime metrics
+
+Counters, gauges and histograms updated by the hot paths, a text format
+dump used by the stats command and an exporter thread that periodically
+writes the dump to a file or a local udp socket.
+"""
+import bisect
+import os
+import socket
+import threading
+import time
+import traceback
+
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Counter:
+    """Counter class
+    A value that only goes up
+    Increments are not locked, a lost update under contention is acceptable
+
+    Parameters:
+    name: str
+        Name of the metric
+    labels: str
+        Preformatted label string, e.g. type="move"
+    """
+    __slots__ = ("name", "labels", "value")
+
+    def __init__(self, name: str, labels: str = ""):
+        self.name = name
+        self.labels = labels
+        self.value = 0
+
+    def inc(self, amount=1):
+        """Increments the counter
+        """
+        self.value += amount
+
+    def dump(self):
+        """Returns the text format lines for this metric
+        """
+        return [f'{self.name}{self.labels} {self.value}']
+
+
+class Gauge(Counter):
+    """Gauge class
+    A value that can be set to anything
+    """
+    __slots__ = ()
+
+    def set(self, value):
+        """Sets the gauge
+        """
+        self.value = value
+
+
+class Histogram:
+    """Histogram class
+    Counts observations into fixed buckets
+
+    Parameters:
+    name: str
+        Name of the metric
+    buckets: tuple[float]
+        Upper bounds of the buckets, sorted
+    """
+
+    def __init__(self, name: str, buckets=DEFAULT_BUCKETS, labels: str = ""):
+        self.name = name
+        self.labels = labels
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        """Records a single observation
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def time(self):
+        """Returns a context manager that observes the time spent inside it
+        """
+        return _Timer(self)
+
+    def percentile(self, pct: float) -> float:
+        """Returns the upper bound of the bucket holding the pct percentile
+        """
+        if self.count == 0:
+            return 0.0
+        rank = self.count * pct / 100
+        seen = 0
+        for (index, count) in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.buckets[index], self.max) if index < len(self.buckets) else self.max
+        return self.max
+
+    def dump(self):
+        """Returns the text format lines for this metric
+        """
+        lines = []
+        seen = 0
+        prefix = self.labels[:-1] + "," if self.labels else "{"
+        for (bound, count) in zip(self.buckets, self.counts):
+            seen += count
+            lines.append(f'{self.name}_bucket{prefix}le="{bound}"}} {seen}')
+        lines.append(f'{self.name}_bucket{prefix}le="+Inf"}} {self.count}')
+        lines.append(f'{self.name}_count{self.labels} {self.count}')
+        lines.append(f'{self.name}_sum{self.labels} {self.sum:.6f}')
+        lines.append(f'{self.name}_max{self.labels} {self.max:.6f}')
+        return lines
+
+
+class _Timer:
+    """Context manager used by Histogram.time
+    """
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class Family:
+    """Family class
+    A group of metrics sharing a name and differing by one label
+    Children are cached so hot paths only pay a dict lookup
+
+    Parameters:
+    name: str
+        Name of the metric
+    label: str
+        Name of the label
+    factory: Callable[[str, str], Any]
+        Builds a child metric from a name and a label string
+    """
+
+    def __init__(self, name: str, label: str, factory):
+        self.name = name
+        self.label = label
+        self.factory = factory
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, value: str):
+        """Returns the child metric for a label value
+        """
+        child = self.children.get(value)
+        if child is None:
+            with self.lock:
+                child = self.children.get(value)
+                if child is None:
+                    child = self.factory(self.name, f'{{{self.label}="{value}"}}')
+                    self.children[value] = child
+        return child
+
+    def dump(self):
+        """Returns the text format lines for every child
+        """
+        lines = []
+        for child in list(self.children.values()):
+            lines.extend(child.dump())
+        return lines
+
+
+class Registry:
+    """Registry class
+    Holds every metric by name, asking twice for a name returns the same metric
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _get(self, name, factory):
+        metric = self.metrics.get(name)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.setdefault(name, factory())
+        return metric
+
+    def counter(self, name: str) -> Counter:
+        """Returns the counter with the given name
+        """
+        return self._get(name, lambda: Counter(name))
+
+    def gauge(self, name: str) -> Gauge:
+        """Returns the gauge with the given name
+        """
+        return self._get(name, lambda: Gauge(name))
+
+    def histogram(self, name: str, buckets=DEFAULT_BUCKETS) -> Histogram:
+        """Returns the histogram with the given name
+        """
+        return self._get(name, lambda: Histogram(name, buckets))
+
+    def counter_family(self, name: str, label: str) -> Family:
+        """Returns a family of counters split by one label
+        """
+        return self._get(name, lambda: Family(name, label, Counter))
+
+    def histogram_family(self, name: str, label: str, buckets=DEFAULT_BUCKETS) -> Family:
+        """Returns a family of histograms split by one label
+        """
+        return self._get(name, lambda: Family(
+            name, label, lambda n, labels: Histogram(n, buckets, labels)))
+
+    def dump(self) -> str:
+        """Returns every metric in a prometheus style text format
+        """
+        lines = []
+        for name in sorted(self.metrics):
+            lines.extend(self.metrics[name].dump())
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """Returns a short human readable summary for the console
+        """
+        lines = []
+        for name in sorted(self.metrics):
+            metric = self.metrics[name]
+            children = (metric.children.items() if isinstance(metric, Family)
+                        else [("", metric)])
+            for (label, child) in children:
+                title = f'{name}[{label}]' if label else name
+                if isinstance(child, Histogram):
+                    lines.append(f'{title}: n={child.count} '
+                                 f'p50<={child.percentile(50) * 1000:.2f}ms '
+                                 f'p99<={child.percentile(99) * 1000:.2f}ms '
+                                 f'max={child.max * 1000:.2f}ms')
+                else:
+                    lines.append(f'{title}: {child.value}')
+        return "\n".join(lines)
+
+
+REGISTRY = Registry()
+
+
+class MetricsExporter(threading.Thread):
+    """MetricsExporter thread
+    Periodically writes the registry in text format
+
+    Parameters:
+    target: str
+        A file path, or udp://host:port to send the dump as a datagram
+    interval: float
+        Seconds between exports
+    registry: Registry
+        The registry to export
+    """
+
+    def __init__(self, target: str, interval: float = 10.0, registry: Registry = REGISTRY,
+                 name: str = "metricsthread"):
+        super(MetricsExporter, self).__init__(name=name)
+        self.target = target
+        self.interval = interval
+        self.registry = registry
+        self.daemon = True
+        self.stop_event = threading.Event()
+        self.start()
+
+    def run(self):
+        print(f"Exporting metrics to {self.target}")
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.export()
+            except OSError as ex:
+                print(f'Error exporting metrics: {ex}')
+                print(traceback.format_exc())
+
+    def export(self):
+        """Writes the current registry to the target
+        """
+        text = self.registry.dump()
+        if self.target.startswith("udp://"):
+            (host, port) = self.target[6:].rsplit(":", 1)
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                sock.sendto(text.encode('utf-8'), (host, int(port)))
+        else:
+            temp = self.target + ".tmp"
+            with open(temp, "w", encoding="utf-8") as file:
+                file.write(text)
+            os.replace(temp, self.target)
+
+    def stop(self):
+        """Stops this thread
+        """
+        self.stop_event.set()
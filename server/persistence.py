@@ -0,0 +1,116 @@
+"""Position persistence
+
+Checkpoints client positions to the database from a background thread so
+the world tick never waits on disk.
+"""
+import sqlite3
+import threading
+import traceback
+from uuid import UUID
+
+from metrics import REGISTRY
+
+
+class Checkpointer(threading.Thread):
+    """Checkpointer thread
+    Writes submitted position rows in one transaction per batch
+
+    Rows are (id, chunk_x, chunk_y, x, y) tuples with the client id as bytes.
+    A row submitted for a client replaces any earlier row for it that has not
+    been written yet, so a batch holds at most one row per client.
+
+    Parameters:
+    database_path: str
+        The database to write to, opened on a connection of its own
+    """
+
+    def __init__(self, database_path: str, name: str = "checkpointthread"):
+        super(Checkpointer, self).__init__(name=name)
+        self.database = sqlite3.connect(database_path, check_same_thread=False)
+        self.database.execute(
+            """CREATE TABLE IF NOT EXISTS
+            positions(id BLOB PRIMARY KEY, chunk_x INT NOT NULL, chunk_y INT NOT NULL,
+            x REAL NOT NULL, y REAL NOT NULL, FOREIGN KEY(id) REFERENCES users(id))"""
+        )
+        self.database.commit()
+        self.database_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.writing = {}
+        self.wakeup = threading.Event()
+        self.running = True
+        self.daemon = True
+        self.write_time = REGISTRY.histogram("checkpoint_seconds")
+        self.rows_written = REGISTRY.counter("checkpoint_rows_total")
+        self.start()
+
+    def run(self):
+        print("Starting Checkpointer")
+        while self.running:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            self.write()
+        self.write()
+        with self.database_lock:
+            self.database.close()
+
+    def submit(self, rows: list):
+        """Queues rows to be written by the next batch
+        Parameters:
+        rows: list[tuple]
+            (id, chunk_x, chunk_y, x, y) rows
+        """
+        with self.lock:
+            for row in rows:
+                self.pending[row[0]] = row
+        self.wakeup.set()
+
+    def load(self, cid: UUID):
+        """Returns the last checkpointed (chunk_x, chunk_y, x, y) of a client or None
+        Rows that are queued or being written are returned before the database is read
+        Parameters:
+        cid: UUID
+            The client's id
+        """
+        key = cid.bytes
+        with self.lock:
+            row = self.pending.get(key) or self.writing.get(key)
+        if row is not None:
+            return row[1:]
+        with self.database_lock:
+            if not self.running and not self.is_alive():
+                return None
+            res = self.database.execute(
+                "SELECT chunk_x, chunk_y, x, y FROM positions WHERE id = (?) LIMIT 1", (key,))
+            return res.fetchone()
+
+    def write(self):
+        """Writes every queued row in one transaction
+        Rows are requeued if the transaction fails unless a newer row arrived
+        """
+        with self.lock:
+            if not self.pending:
+                return
+            (self.writing, self.pending) = (self.pending, {})
+            rows = list(self.writing.values())
+        with self.database_lock, self.write_time.time():
+            try:
+                self.database.executemany(
+                    """INSERT OR REPLACE INTO positions VALUES(?, ?, ?, ?, ?)""", rows)
+                self.database.commit()
+                self.rows_written.inc(len(rows))
+            except sqlite3.Error as ex:
+                print(f"An error occurred: {ex}\nRolling back checkpoint...")
+                print(traceback.format_exc())
+                self.database.rollback()
+                with self.lock:
+                    for row in rows:
+                        self.pending.setdefault(row[0], row)
+        with self.lock:
+            self.writing = {}
+
+    def stop(self):
+        """Writes what is left and stops this thread
+        """
+        self.running = False
+        self.wakeup.set()
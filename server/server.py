@@ -3,11 +3,13 @@ Server Main File
 """
 import sys
 import os
+import select
 import socket
 import threading
 import sqlite3
 import json
 import base64
+import time
 import traceback
 from typing import Union
 from uuid import UUID, uuid4
@@ -17,10 +19,20 @@ import rsa
 
 import world
 import websocketrelay
+import metrics
+import persistence
 
 from clienthandler import Client, ClientThread
 from command import Command, CommandProcessor
 from messagebuilder import MessageRelay, build_message_generic
+from metrics import REGISTRY
+from capture import CaptureWriter, WEBSOCKET
+from admission import AdmissionQueue
+from fragments import Reassembler
+from utils import is_finite_number
+from chat import CHANNELS
+from tracing import TRACER
+from clock import CLOCK
 
 server = []
 
@@ -31,6 +43,34 @@ def get_server_thread():
     return server[0]
 
 
+def load_keys(path: str, max_age: float = 30 * 24 * 60 * 60):
+    """Loads the server's RSA key pair from a key file
+    A new pair is generated and saved when the file is missing, unreadable or
+    older than max_age seconds
+    Parameters:
+    path: str
+        The PEM file holding the private key
+    max_age: float
+        Seconds after which the key is rotated
+    """
+    try:
+        if time.time() - os.path.getmtime(path) < max_age:
+            with open(path, "rb") as file:
+                privatekey = rsa.PrivateKey.load_pkcs1(file.read())
+            return rsa.PublicKey(privatekey.n, privatekey.e), privatekey
+        print(f'Rotating key in {path}')
+    except FileNotFoundError:
+        print(f'Generating key in {path}')
+    except Exception as ex:  # A corrupt key file raises pyasn1 errors as well as ValueError
+        print(f'Could not load key from {path}: {ex}')
+    (publickey, privatekey) = rsa.newkeys(1024)
+    temp = path + ".tmp"
+    with open(os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as file:
+        file.write(privatekey.save_pkcs1())
+    os.replace(temp, path)
+    return publickey, privatekey
+
+
 class InputThread(threading.Thread):
     """ Input Thread
     """
@@ -75,15 +115,41 @@ class ServerThread(threading.Thread):
     keyboard = None
     running = True
 
-    def __init__(self, ip=None, port=None,  name='serverthread'):
+    def __init__(self, ip=None, port=None, metrics_target=None, metrics_interval=10.0,
+                 capture_path=None, sock=None, database_path="data.db", keys=None,
+                 key_path=None, key_max_age=30 * 24 * 60 * 60, session_path=None,
+                 session_max_age=300, max_sessions=1000, max_auth_inflight=2,
+                 max_auth_queue=256, recv_batch=64, recv_size=65535, clock=None,
+                 lockstep=False, interactive=True, name='serverthread'):
         super(ServerThread, self).__init__(name=name)
+        self.boot_time = time.perf_counter()
         self.ip = ip
         self.port = port
-        self.keyboard = InputThread(self.input_clbk)
+        self.keyboard = InputThread(self.input_clbk) if interactive else None
         self.init_requests()
-        (self.publickey, self.privatekey) = rsa.newkeys(1024)
-        self.p_key = self.publickey.save_pkcs1().decode('utf-8')
-        self.sock = None
+        self.keys = keys
+        self.key_path = key_path
+        self.key_max_age = key_max_age
+        self.session_path = session_path
+        self.session_max_age = session_max_age
+        self.max_sessions = max_sessions
+        self.max_auth_inflight = max_auth_inflight
+        self.max_auth_queue = max_auth_queue
+        self.admission = None
+        self.database_lock = threading.RLock()
+        self.clock = clock or CLOCK
+        self.lockstep = lockstep
+        self.reassembler = Reassembler(clock=self.clock)
+        self.buffers = [bytearray(recv_size) for _ in range(recv_batch)]
+        self.views = [memoryview(buffer) for buffer in self.buffers]
+        self.received = [None] * recv_batch
+        self.publickey = None
+        self.privatekey = None
+        self.p_key = None
+        self.sock = sock
+        self.database_path = database_path
+        self.capture_path = capture_path
+        self.capture = None
         self.message_handler = None
         self.client_handler = None
         self.world_handler = None
@@ -92,26 +158,106 @@ class ServerThread(threading.Thread):
         self.server_client = None
         self.command_processor = None
         self.websocket_relay = None
+        self.checkpointer = None
+        self.packets_received = REGISTRY.counter("packets_in_total")
+        self.request_counts = REGISTRY.counter_family("requests_total", "type")
+        self.receive_batches = REGISTRY.counter("receive_batches_total")
+        self.auth_time = REGISTRY.histogram("auth_seconds")
+        self.commit_time = REGISTRY.histogram("db_commit_seconds")
+        self.metrics_target = metrics_target
+        self.metrics_interval = metrics_interval
+        self.metrics_exporter = None
+        self.startup_time = REGISTRY.gauge("startup_seconds")
+        self.first_packet_time = REGISTRY.gauge("first_packet_seconds")
+        self.first_packet = True
+        self.first_packet_lock = threading.Lock()
+        self.tracer = TRACER
         self.start()
 
     def init_requests(self):
         """Initializes Request Handlers
         """
         self.requests["init-session"] = self.init_session
+        self.auth_handlers = {
+            "init-session": self.authenticate,
+            "register": self.register
+        }
         self.requests["end-session"] = self.end_session
         self.requests["message"] = self.message
+        self.requests["join-room"] = self.join_room
+        self.requests["leave-room"] = self.leave_room
         self.requests["update"] = self.update_clients
+        self.requests["snapshot-ack"] = self.snapshot_ack
         self.requests["confirm"] = self.confirm
         self.requests["ping"] = self.ping
         self.requests["obtain-public"] = self.sendkey
-        self.requests["register"] = self.register
+        self.requests["register"] = self.queue_register
         self.requests["move"] = self.move
         self.requests["end-move"] = self.end_move
+        self.requests["server-stats"] = self.server_stats
+        self.requests["fragment"] = self.fragment
+
+    def load_keys(self):
+        """Loads the RSA key pair
+        Uses the keys passed to the constructor, then the key file, and only
+        generates a throwaway pair when neither is set
+        """
+        if self.keys is not None:
+            (self.publickey, self.privatekey) = self.keys
+        elif self.key_path:
+            (self.publickey, self.privatekey) = load_keys(self.key_path, self.key_max_age)
+        else:
+            (self.publickey, self.privatekey) = rsa.newkeys(1024)
+        self.p_key = self.publickey.save_pkcs1().decode('utf-8')
+
+    def load_sessions(self):
+        """Restores the sessions saved by the last run
+        The snapshot is removed once read and ignored when older than session_max_age
+        """
+        if not self.session_path:
+            return
+        try:
+            age = time.time() - os.path.getmtime(self.session_path)
+            with open(self.session_path, "r", encoding="utf-8") as file:
+                snapshot = json.load(file)
+            os.remove(self.session_path)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as ex:
+            print(f'Could not load sessions from {self.session_path}: {ex}')
+            return
+        if age > self.session_max_age:
+            print(f'Ignoring sessions saved {age:.0f}s ago')
+            return
+        try:
+            restored = self.client_handler.restore_sessions(snapshot["sessions"])
+        except (KeyError, TypeError, ValueError) as ex:
+            print(f'Could not restore sessions: {ex}')
+            print(traceback.format_exc())
+            return
+        print(f'Restored {restored} sessions')
+
+    def save_sessions(self):
+        """Saves every live session so the next run can restore it
+        The file holds session tokens and is only readable by its owner
+        """
+        sessions = self.client_handler.export_sessions()
+        temp = self.session_path + ".tmp"
+        try:
+            with open(os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w",
+                      encoding="utf-8") as file:
+                json.dump({"sessions": sessions}, file)
+            os.replace(temp, self.session_path)
+        except OSError as ex:
+            print(f'Could not save sessions to {self.session_path}: {ex}')
+            print(traceback.format_exc())
+            return
+        print(f'Saved {len(sessions)} sessions')
 
     def connect_databases(self):
         """Connects to the database
         """
-        self.database = sqlite3.connect("data.db", check_same_thread=False)
+        self.database = sqlite3.connect(self.database_path, check_same_thread=False)
         self.database_cur = self.database.cursor()
 
         self.database_cur.execute(
@@ -144,7 +290,7 @@ class ServerThread(threading.Thread):
         """ Sets up usuable commands
         """
         self.server_client = Client(
-            UUID(int=1), "SERVER", datetime.now(), privilege_level=99)
+            UUID(int=1), "SERVER", self.clock.now(), privilege_level=99)
         self.command_processor = CommandProcessor([
             Command('commands', lambda args, executor: (
                 print('-=COMMANDS=-'),
@@ -155,11 +301,25 @@ class ServerThread(threading.Thread):
                 print("Stopping server"),
                 get_server_thread().close_server() if get_server_thread() is not None else 0
             ), 99),
+            Command('stats', lambda args, executor: (
+                print(REGISTRY.summary())
+            ), privilege_req=99),
+            Command('trace', lambda args, executor: (
+                get_server_thread().trace_command(args)
+            ), 'on|off|dump', 'slow-ms', privilege_req=99),
+            Command('capture', lambda args, executor: (
+                get_server_thread().stop_capture() if args and args[0].lower() == 'off'
+                else get_server_thread().start_capture(args[0]) if args
+                else print("Not enough arguments")
+            ), 'file|off', privilege_req=99),
             Command('printqueue', lambda args, executor: (
                 print(get_server_thread().message_handler.get_waiting())
             ), 99),
+            Command('memory', lambda args, executor: (
+                print(get_server_thread().client_handler.memory_report())
+            ), privilege_req=99),
             Command('listplayers', lambda args, executor: (
-                print(get_server_thread().client_handler.list_clients())
+                print(get_server_thread().world_handler.get_snapshot().list_players())
             )),
             Command('kick', lambda args, executor: (
                 print("Not enough arguments") if len(args) < 1 else (
@@ -182,42 +342,54 @@ class ServerThread(threading.Thread):
 
     def run(self):
         print("Starting server")
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.sock.setblocking(1)
-        self.sock.settimeout(5)
-        self.sock.bind((self.ip, self.port))
+        if self.sock is None:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sock.setblocking(False)
+            self.sock.bind((self.ip, self.port))
+            self.websocket_relay = websocketrelay.WebSocketServer(self, self.port)
+        self.load_keys()
         self.connect_databases()
         self.setup_commands()
-        self.websocket_relay = websocketrelay.WebSocketServer(self, self.port)
-        self.message_handler = MessageRelay(self.sock, self.websocket_relay)
-        self.client_handler = ClientThread(self, clbk=self.client_clbk)
+        if self.capture_path:
+            self.start_capture(self.capture_path)
+        self.message_handler = MessageRelay(self.sock, self.websocket_relay, clock=self.clock,
+                                            lockstep=self.lockstep)
+        self.client_handler = ClientThread(self, clbk=self.client_clbk, clock=self.clock)
+        self.admission = AdmissionQueue(self, self.max_auth_inflight, self.max_auth_queue)
+        self.checkpointer = persistence.Checkpointer(self.database_path)
         self.world_handler = world.World(
-            "WorldName", self.message_handler, self.client_handler, 64, 64)
+            "WorldName", self.message_handler, self.client_handler, 64, 64,
+            checkpointer=self.checkpointer, clock=self.clock)
+        self.load_sessions()
+        if self.metrics_target:
+            self.metrics_exporter = metrics.MetricsExporter(
+                self.metrics_target, self.metrics_interval)
+        self.startup_time.set(time.perf_counter() - self.boot_time)
+        print(f'Ready in {self.startup_time.value * 1000:.1f}ms')
+        wait = getattr(self.sock, "wait", None) or self.wait_readable
         try:
             while self.running:
-                if ((self.sock is None or self.sock.fileno() == -1)
-                        or not self.running or not self.keyboard.is_alive()):
+                if ((self.sock is None or self.sock.fileno() == -1) or not self.running
+                        or (self.keyboard is not None and not self.keyboard.is_alive())):
                     break
-                try:
-                    data, addr = self.sock.recvfrom(1024)
-                except ConnectionResetError:
+                if not wait(1.0):
                     continue
-                except BlockingIOError:
+                count = self.receive_batch()
+                if not count:
                     continue
-                except TimeoutError:
-                    continue
-                except OSError as ex:
-                    if self.running:
-                        print(f"Server error: {ex}")
-                        print(traceback.format_exc())
-                    continue
-                if not data:
-                    continue
-                self.decode_json(data, addr)
-
-                # self.sock.sendto(b'Message Recieved', addr)
-                # print("message: %s" % data.decode('utf-8'))
+                self.clock.sample()
+                self.receive_batches.inc()
+                self.packets_received.inc(count)
+                for index in range(count):
+                    (size, addr) = self.received[index]
+                    data = self.views[index][:size]
+                    if self.capture is not None:
+                        self.capture.write(data, addr)
+                    self.decode_json(data, addr)
+                self.message_handler.request_flush()
+                if self.first_packet:
+                    self.record_first_packet()
         except OSError as ex:
             print(f"Server error: {ex}")
             print(traceback.format_exc())
@@ -226,49 +398,129 @@ class ServerThread(threading.Thread):
         self.sock.close()
         self.close_databases()
 
-    def decode_json(self, data, addr):
+    def wait_readable(self, timeout: float) -> bool:
+        """Waits up to timeout seconds for the socket to have packets
+        """
+        try:
+            return bool(select.select([self.sock], [], [], timeout)[0])
+        except (OSError, ValueError):
+            return False
+
+    def receive_batch(self) -> int:
+        """Reads queued packets into the receive buffers until the socket would block
+        Returns the number of packets read, their sizes and addresses are in received
+        """
+        count = 0
+        limit = len(self.buffers)
+        while count < limit:
+            try:
+                self.received[count] = self.sock.recvfrom_into(self.buffers[count])
+            except (BlockingIOError, InterruptedError):
+                break
+            except ConnectionResetError:
+                continue
+            except OSError as ex:
+                if self.running:
+                    print(f"Server error: {ex}")
+                    print(traceback.format_exc())
+                break
+            if self.received[count][0]:
+                count += 1
+        return count
+
+    def decode_json(self, data, addr, reassembled=False):
         """Decodes recieved json files
+        When tracing is enabled records parse, handler and lock wait times
+        Reassembled payloads may not be fragments themselves
+        Parameters:
+        data: bytes or memoryview
+            The packet, views into the receive buffers are decoded without copying
         """
+        request = None
+        tracing = self.tracer.enabled
         try:
-            dat = json.loads(data.decode('utf-8'))
+            if tracing:
+                self.tracer.begin()
+                start = time.perf_counter()
+            dat = json.loads(str(data, 'utf-8'))
             request = dat["request"]
-            if "session-id" in dat:
-                res = self.client_handler.update_client_bses_ts(
-                    dat["session-id"])
-                if res is False:
+            if reassembled and request == "fragment":
+                raise ValueError("Nested fragment")
+            if tracing:
+                parsed = time.perf_counter()
+            self.request_counts.labels(
+                request if request in self.requests else "invalid").inc()
+            if "session-id" in dat or "conn" in dat:
+                client = self.client_handler.resolve(dat, addr)
+                if client is None:
                     self.message_handler.send_message(addr, build_message_generic(
                         'info', 'kicked', 'You were not connected to the servr.'))
                     return False
-            return self.requests[request](dat, addr)
-        except ValueError:
+                client.last_response = self.clock.now()
+            result = self.requests[request](dat, addr)
+            if tracing:
+                self.tracer.finish(request, parsed - start, time.perf_counter() - parsed, addr)
+            return result
+        except (ValueError, TypeError, AttributeError):
+            # Non object json and values of the wrong type are malformed as well
             error_response = build_message_generic(
                 "error", "malformed-data", 'Supplied data was invalid.')
             self.message_handler.send_message(addr, error_response)
             print("Error: Malformed data.")
-            print(traceback.format_exc())
+            self.tracer.error(request, addr, traceback.format_exc())
         except KeyError:
             error_response = build_message_generic(
                 "error", "invalid-request", f'{request} is not a valid request type.')
             self.message_handler.send_message(addr, error_response)
             print(f'Error: {request} is not a valid request type.')
-            print(traceback.format_exc())
+            self.tracer.error(request, addr, traceback.format_exc())
         except OSError as ex:
             error_response = build_message_generic(
                 "error", "internal-error", 'An internal server error has occurred')
             self.message_handler.send_message(addr, error_response)
             print(f'Error: {ex}')
-            print(traceback.format_exc())
+            self.tracer.error(request, addr, traceback.format_exc())
+
+    def fragment(self, data, addr) -> bool:
+        """Collects a fragment of a large request and handles the request once complete
+        """
+        payload = self.reassembler.add(addr, data)
+        if payload is None:
+            return False
+        return self.decode_json(payload, addr, reassembled=True)
 
     def init_session(self, data, addr) -> bool:
-        """Initializes user sessions
+        """Queues a login for the auth workers
+        Turned away at once when the server is full
+        """
+        if len(self.client_handler.client_list) >= self.max_sessions:
+            self.admission.reject(addr, "server-full", 'The server is full, try again later.')
+            return False
+        return self.admission.submit("init-session", data, addr)
+
+    def queue_register(self, data, addr) -> bool:
+        """Queues a registration for the auth workers
+        """
+        return self.admission.submit("register", data, addr)
+
+    def authenticate(self, data, addr) -> bool:
+        """Logs a client in on an auth worker
+        Records the time taken in auth_seconds
+        """
+        with self.auth_time.time():
+            return self.login(data, addr)
+
+    def login(self, data, addr) -> bool:
+        """Verifies a client's credentials and adds it to the client handler
         """
         print('initing session')
         username = data['username']
         password = data['password']
 
-        pres = self.database_cur.execute(
-            "SELECT password FROM users WHERE name = (?) LIMIT 1", (username,))
-        passw = pres.fetchone()
+        with self.database_lock:
+            pres = self.database_cur.execute(
+                "SELECT password FROM users WHERE name = (?) LIMIT 1", (username,))
+            passw = pres.fetchone()
 
         if passw is None or passw[0] is None:
             error_response = build_message_generic(
@@ -285,32 +537,44 @@ class ServerThread(threading.Thread):
             return False
 
         if bcrypt.checkpw(password, passw[0]):
-            req = self.database_cur.execute(
-                "SELECT id, name FROM users WHERE name = (?) LIMIT 1", (username,))
-            val = req.fetchone()
-            perm_req = self.database_cur.execute(
-                "SELECT privilege_level FROM permissions WHERE id = (?) LIMIT 1", (val[0],))
-            priv = perm_req.fetchone()
-            if priv is None:
-                priv = (0,)
-                self.database_cur.execute("""BEGIN""")
-                try:
-                    self.database_cur.execute(
-                        """INSERT INTO permissions VALUES(?, ?)""", (val[0], 0))
-                    self.database.commit()
-                except sqlite3.Error as ex:
-                    print(
-                        f"An error occurred: {ex}\nRolling back databases...")
-                    print(traceback.format_exc())
-                    self.database.rollback()
-                    error_response = build_message_generic(
-                        "error", "data-error", 'An error occurred')
-                    self.message_handler.send_message(addr, error_response)
-                    return False
+            with self.database_lock:
+                req = self.database_cur.execute(
+                    "SELECT id, name FROM users WHERE name = (?) LIMIT 1", (username,))
+                val = req.fetchone()
+                perm_req = self.database_cur.execute(
+                    "SELECT privilege_level FROM permissions WHERE id = (?) LIMIT 1", (val[0],))
+                priv = perm_req.fetchone()
+                if priv is None:
+                    priv = (0,)
+                    self.database_cur.execute("""BEGIN""")
+                    try:
+                        self.database_cur.execute(
+                            """INSERT INTO permissions VALUES(?, ?)""", (val[0], 0))
+                        with self.commit_time.time():
+                            self.database.commit()
+                    except sqlite3.Error as ex:
+                        print(
+                            f"An error occurred: {ex}\nRolling back databases...")
+                        print(traceback.format_exc())
+                        self.database.rollback()
+                        error_response = build_message_generic(
+                            "error", "data-error", 'An error occurred')
+                        self.message_handler.send_message(addr, error_response)
+                        return False
             uuid_temp = UUID(bytes=val[0])
             client = Client(
-                uuid_temp, val[1], datetime.now(), privilege_level=priv[0])
-            login = self.client_handler.add_client(client)
+                uuid_temp, val[1], self.clock.now(), privilege_level=priv[0])
+            # Read before taking the clients lock, the checkpointer waits on the database
+            position = None
+            if self.checkpointer is not None:
+                position = self.checkpointer.load(uuid_temp)
+            with self.client_handler.lock:
+                if (len(self.client_handler.client_list) >= self.max_sessions
+                        and self.client_handler.get_client(client.id) is None):
+                    self.admission.reject(
+                        addr, "server-full", 'The server is full, try again later.')
+                    return False
+                login = self.client_handler.add_client(client, position)
 
             if login is False:
                 client = self.client_handler.get_client(username)
@@ -320,18 +584,20 @@ class ServerThread(threading.Thread):
                         "error", "already-connected", 'User is already logged in.')
                     self.message_handler.send_message(addr, error_response)
                     return False
-            client.set_addr(addr)
+            self.client_handler.set_client_addr(client, addr)
             self.client_handler.update_client_ts(client.id)
             success_response = {
                 "response": "success",
                 "type": "login-success",
                 "session": client.get_session(),
+                "conn": client.conn,
                 "name": client.name,
                 "id": str(client.id),
                 "chunk-width": self.world_handler.chunk_width,
                 "chunk-height": self.world_handler.chunk_height,
                 "world-width": self.world_handler.width,
-                "world-height": self.world_handler.height
+                "world-height": self.world_handler.height,
+                "tick-rate": self.world_handler.tps
             }
             self.message_handler.send_message(addr, success_response)
             return True
@@ -358,9 +624,10 @@ class ServerThread(threading.Thread):
             self.message_handler.send_message(addr, error_response)
             return False
 
-        res = self.database_cur.execute(
-            "SELECT EXISTS (SELECT 1 FROM users WHERE name = (?))", (username,))
-        result = res.fetchone()
+        with self.database_lock:
+            res = self.database_cur.execute(
+                "SELECT EXISTS (SELECT 1 FROM users WHERE name = (?))", (username,))
+            result = res.fetchone()
 
         if result is None or result[0] == 1:
             error_response = build_message_generic(
@@ -378,22 +645,24 @@ class ServerThread(threading.Thread):
 
         hashed_password = bcrypt.hashpw(password, bcrypt.gensalt(10))
 
-        self.database_cur.execute("""BEGIN""")
-        try:
-            uid = uuid4().bytes
-            self.database_cur.execute(
-                """INSERT INTO users VALUES(?, ?, ?)""", (uid, username, hashed_password))
-            self.database_cur.execute(
-                """INSERT INTO permissions VALUES(?, ?)""", (uid, 0))
-            self.database.commit()
-        except sqlite3.Error as ex:
-            print(f"An error occurred: {ex}\nRolling back databases...")
-            print(traceback.format_exc())
-            self.database.rollback()
-            error_response = build_message_generic(
-                "error", "data-error", 'An error occurred')
-            self.message_handler.send_message(addr, error_response)
-            return False
+        with self.database_lock:
+            self.database_cur.execute("""BEGIN""")
+            try:
+                uid = uuid4().bytes
+                self.database_cur.execute(
+                    """INSERT INTO users VALUES(?, ?, ?)""", (uid, username, hashed_password))
+                self.database_cur.execute(
+                    """INSERT INTO permissions VALUES(?, ?)""", (uid, 0))
+                with self.commit_time.time():
+                    self.database.commit()
+            except sqlite3.Error as ex:
+                print(f"An error occurred: {ex}\nRolling back databases...")
+                print(traceback.format_exc())
+                self.database.rollback()
+                error_response = build_message_generic(
+                    "error", "data-error", 'An error occurred')
+                self.message_handler.send_message(addr, error_response)
+                return False
 
         success_response = build_message_generic(
             "success", "register-success", f'User {username} was created successfully!')
@@ -424,92 +693,145 @@ class ServerThread(threading.Thread):
             return False
 
     def message(self, data, addr):
-        """ Sends client chat messages to the message handler
+        """ Sends client chat messages to the world's chat router
+        channel: str Optional
+            global, local or room, defaults to global
+        room: str Optional
+            The room to send to when channel is room
         """
-        if 'session-id' not in data or 'message' not in data:
+        if ('session-id' not in data and 'conn' not in data) or 'message' not in data:
             error_response = build_message_generic(
                 "error", "missing-data", "Required data is missing")
             self.message_handler.send_message(addr, error_response)
             return False
-        session_id = data['session-id']
         message = data['message']
+        channel = data.get('channel', 'global')
+        room = data.get('room')
 
         if not message.strip():
             return False
 
-        client = self.client_handler.get_client_ses(session_id)
+        if channel not in CHANNELS or (channel == 'room' and not isinstance(room, str)):
+            error_response = build_message_generic(
+                "error", "invalid-channel", "Channel was invalid")
+            self.message_handler.send_message(addr, error_response)
+            return False
+
+        client = self.client_handler.resolve(data, addr)
         if client is None:
             error_response = build_message_generic(
                 "error", "incorrect-data", "Important data is incorrect")
             self.message_handler.send_message(addr, error_response)
             return False
 
-        self.database_cur.execute("""BEGIN""")
-        try:
-            self.database_cur.execute(
-                """INSERT INTO messages VALUES(?, ?, ?, ?)""",
-                (uuid4().bytes, datetime.now(), message, client.id.bytes))
-            self.database.commit()
-        except sqlite3.Error as ex:
-            print(f"An error occurred: {ex}\nRolling back databases...")
-            print(traceback.format_exc())
-            self.database.rollback()
+        with self.database_lock:
+            self.database_cur.execute("""BEGIN""")
+            try:
+                self.database_cur.execute(
+                    """INSERT INTO messages VALUES(?, ?, ?, ?)""",
+                    (uuid4().bytes, datetime.now(), message, client.id.bytes))
+                with self.commit_time.time():
+                    self.database.commit()
+            except sqlite3.Error as ex:
+                print(f"An error occurred: {ex}\nRolling back databases...")
+                print(traceback.format_exc())
+                self.database.rollback()
+                error_response = build_message_generic(
+                    "error", "data-error", 'An error occurred')
+                self.message_handler.send_message(addr, error_response)
+                return False
+
+        self.world_handler.post_chat(client, channel, message, room)
+        return True
+
+    def join_room(self, data, addr):
+        """ Subscribes a client to a chat room
+        """
+        if 'room' not in data or not isinstance(data['room'], str) or not data['room'].strip():
             error_response = build_message_generic(
-                "error", "data-error", 'An error occurred')
+                "error", "missing-data", "Required data is missing")
             self.message_handler.send_message(addr, error_response)
             return False
+        client = self.client_handler.resolve(data, addr)
+        if client is None:
+            return False
+        self.world_handler.join_room(client, data['room'].strip()[:32])
+        return True
 
-        message_json = {
-            "response": "message",
-            "origin": str(client.id),
-            "message": message
-        }
-        self.client_handler.send_message_to_all(
-            message_json, self.message_handler)
+    def leave_room(self, data, addr):
+        """ Unsubscribes a client from a chat room
+        """
+        if 'room' not in data or not isinstance(data['room'], str):
+            error_response = build_message_generic(
+                "error", "missing-data", "Required data is missing")
+            self.message_handler.send_message(addr, error_response)
+            return False
+        client = self.client_handler.resolve(data, addr)
+        if client is None:
+            return False
+        self.world_handler.leave_room(client, data['room'].strip()[:32])
         return True
 
     def move(self, data, addr):
         """ Sends client movement to the World thread for handling
+        The velocity must be a finite number on both axes
         """
-        if 'session-id' not in data not in data:
+        if (('session-id' not in data and 'conn' not in data)
+                or not is_finite_number(data.get('x')) or not is_finite_number(data.get('y'))):
             error_response = build_message_generic(
                 "error", "missing-data", "Required data is missing")
             self.message_handler.send_message(addr, error_response)
             return False
-        session_id = data['session-id']
         vel = [data['x'], data['y']]
-        client = self.client_handler.get_client_ses(session_id)
-        client.move(vel)
+        client = self.client_handler.resolve(data, addr)
+        if client is None:
+            return False
+        self.world_handler.set_velocity(client, vel)
         return True
 
     def end_move(self, data, addr):
         """ Ends movment of a client
         """
-        if 'session-id' not in data not in data:
+        if 'session-id' not in data and 'conn' not in data:
             error_response = build_message_generic(
                 "error", "missing-data", "Required data is missing")
             self.message_handler.send_message(addr, error_response)
             return False
-        session_id = data['session-id']
-        client = self.client_handler.get_client_ses(session_id)
-        client.move([0, 0])
+        client = self.client_handler.resolve(data, addr)
+        if client is None:
+            return False
+        self.world_handler.set_velocity(client, [0, 0])
         return True
 
     def update_clients(self, data, addr):
         """ Requests the World thread to update a client
         """
-        if 'session-id' not in data:
+        if 'session-id' not in data and 'conn' not in data:
             error_response = build_message_generic(
                 "error", "missing-data", "Required data is missing")
             self.message_handler.send_message(addr, error_response)
             return False
 
-        session_id = data['session-id']
-        client = self.client_handler.get_client_ses(session_id)
-        with self.world_handler.lock:
-            self.world_handler.full_update(client)
+        client = self.client_handler.resolve(data, addr)
+        if client is None:
+            return False
+        self.world_handler.full_update(client)
         return True
 
+    def snapshot_ack(self, data, addr):
+        """ Acknowledges pages of a join snapshot stream
+        """
+        if (not isinstance(data.get('snapshot'), int) or not isinstance(data.get('count'), int)
+                or isinstance(data['snapshot'], bool) or isinstance(data['count'], bool)):
+            error_response = build_message_generic(
+                "error", "missing-data", "Required data is missing")
+            self.message_handler.send_message(addr, error_response)
+            return False
+        client = self.client_handler.resolve(data, addr)
+        if client is None:
+            return False
+        return self.world_handler.ack_stream(client, data['snapshot'], data['count'])
+
     def confirm(self, data, addr):
         """Confirms a packet
         """
@@ -527,6 +849,25 @@ class ServerThread(threading.Thread):
         """
         return False
 
+    def server_stats(self, _data, addr):
+        """Sends raw server counters to a local benchmark client
+        Only answers requests from the loopback address
+        """
+        if addr[0] not in ("127.0.0.1", "::1", "localhost"):
+            return False
+        data = {
+            "response": "server-stats",
+            "cpu": time.process_time(),
+            "ticks": self.world_handler.tick,
+            "tick-time": self.world_handler.tick_time.sum,
+            "packets-in": self.packets_received.value,
+            "packets-out": self.message_handler.packets_sent.value,
+            "retransmits": self.message_handler.packets_resent.value,
+            "clients": len(self.world_handler.get_snapshot())
+        }
+        self.message_handler.send_message(addr, data)
+        return True
+
     def sendkey(self, data, addr):
         """Sends the public key
         """
@@ -537,6 +878,44 @@ class ServerThread(threading.Thread):
         self.message_handler.send_message(addr, data)
         return True
 
+    def start_capture(self, path: str):
+        """ Starts capturing inbound packets to a file
+        """
+        self.stop_capture()
+        self.capture = CaptureWriter(path, self.privatekey)
+        print(f'Capturing packets to {path}')
+
+    def stop_capture(self):
+        """ Stops capturing inbound packets
+        """
+        capture = self.capture
+        self.capture = None
+        if capture is not None:
+            capture.close()
+            print(f'Captured {capture.count} packets to {capture.path}')
+
+    def trace_command(self, args):
+        """ Handles the trace command
+        trace on [slow-ms] enables tracing, trace off disables it and
+        trace dump prints sampled slow and failed requests
+        """
+        action = args[0].lower() if args else 'dump'
+        match action:
+            case 'on':
+                try:
+                    threshold = float(args[1]) / 1000 if len(args) > 1 else None
+                except ValueError:
+                    print(f'{args[1]} is not a number.')
+                    return
+                self.tracer.enable(threshold)
+                print(f'Tracing enabled, sampling requests over '
+                      f'{self.tracer.slow_threshold * 1000:.2f}ms')
+            case 'off':
+                self.tracer.disable()
+                print('Tracing disabled')
+            case _:
+                print(self.tracer.dump())
+
     def input_clbk(self, inp):
         """ Handles commands from the input thread
         """
@@ -553,26 +932,58 @@ class ServerThread(threading.Thread):
         """
         match req.lower():
             case 'relay-message':
-                self.sock.sendto(param['json'], param['addr'])
+                self.message_handler.send_datagram(param['json'], param['addr'])
             case 'kick':
                 self.message_handler.send_message(param['addr'], build_message_generic(
                     'info', 'kicked', 'You have been kicked from the server.'))
 
-    def process_websocket_message(self, message: str, addr: Union[str, tuple]):
+    def process_websocket_message(self, message: Union[str, bytes], addr: Union[str, tuple]):
         """ Handles requests passed from the websocketrelay
         """
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+        self.packets_received.inc()
+        if self.capture is not None:
+            self.capture.write(message, addr, WEBSOCKET)
         self.decode_json(message, addr)
+        if self.first_packet:
+            self.record_first_packet()
+
+    def record_first_packet(self):
+        """Records how long after start the first request was handled
+        Called by the udp loop and the websocketrelay, whichever handles one first
+        """
+        with self.first_packet_lock:
+            if not self.first_packet:
+                return
+            self.first_packet = False
+        self.first_packet_time.set(time.perf_counter() - self.boot_time)
+        print(f'First packet handled {self.first_packet_time.value * 1000:.1f}ms after start')
 
     def stop_all_threads(self):
         """ Tells all threads to stop
         """
         try:
-            self.client_handler.stop()
+            if self.admission is not None:
+                self.admission.stop()
+            self.client_handler.stop(kick=not self.session_path)
             if self.client_handler is not None:
                 self.client_handler.join()
             self.message_handler.stop()
             self.world_handler.stop()
-            self.keyboard.stop()
+            self.world_handler.join()
+            if self.session_path:
+                self.save_sessions()
+            if self.checkpointer is not None:
+                self.checkpointer.stop()
+                self.checkpointer.join()
+            if self.keyboard is not None:
+                self.keyboard.stop()
+            self.stop_capture()
+            if self.metrics_exporter is not None:
+                self.metrics_exporter.stop()
+            if self.websocket_relay is not None:
+                self.websocket_relay.stop()
             if self.message_handler is not None:
                 self.message_handler.join()
         except OSError as ex:
@@ -591,7 +1002,10 @@ class ServerThread(threading.Thread):
 
 
 if __name__ == '__main__':
-    server.append(ServerThread("", 25555))
+    server.append(ServerThread("", 25555, metrics_target=os.environ.get("METRICS_EXPORT"),
+                               capture_path=os.environ.get("CAPTURE_FILE"),
+                               key_path=os.environ.get("KEY_FILE", "server_key.pem"),
+                               session_path=os.environ.get("SESSION_FILE")))
     try:
         if server[0] is not None:
             server[0].join()
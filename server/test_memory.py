@@ -0,0 +1,71 @@
+"""Memory footprint test
+
+Logs bench bots into a server on a local port and checks the memory
+ClientThread.memory_report measures per connected player.
+
+Run from this directory with ```python -m unittest test_memory```
+"""
+import asyncio
+import socket
+import unittest
+
+# websocketrelay imports server, importing it first resolves the cycle
+import websocketrelay  # noqa: F401
+import bench
+from server import ServerThread
+
+# Bots logged in before measuring
+PLAYERS = 20
+# Largest accepted client and index bytes per connected player
+MAX_BYTES_PER_PLAYER = 1024
+
+
+def free_port() -> int:
+    """Returns a udp port on localhost that is free right now
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class MemoryFootprintTest(unittest.TestCase):
+    """Measures the bytes held per logged in player
+    """
+
+    def setUp(self):
+        self.port = free_port()
+        self.server = ServerThread("127.0.0.1", self.port, database_path=":memory:",
+                                   interactive=False)
+
+    def tearDown(self):
+        self.server.close_server()
+        self.server.join(10)
+
+    async def measure(self, bots: list):
+        """Logs the bots in a few at a time, measures and logs them out
+        Returns which bots logged in and the memory report
+        """
+        for bot in bots:
+            await bot.connect()
+        gate = asyncio.Semaphore(4)
+
+        async def login(bot):
+            async with gate:
+                return await bot.login("memory-test")
+        try:
+            logins = await asyncio.gather(*[login(bot) for bot in bots])
+            return logins, self.server.client_handler.memory_report()
+        finally:
+            await asyncio.gather(*[bot.logout() for bot in bots])
+
+    def test_bytes_per_player(self):
+        benchmark = bench.Benchmark(bench.parse_args(["--port", str(self.port)]))
+        bots = [bench.Bot(benchmark, f'memorybot{i}') for i in range(PLAYERS)]
+        (logins, report) = asyncio.run(self.measure(bots))
+        self.assertEqual(sum(logins), PLAYERS)
+        self.assertEqual(report["clients"], PLAYERS)
+        self.assertLess(report["bytes-per-player"], MAX_BYTES_PER_PLAYER, report)
+
+
+if __name__ == '__main__':
+    unittest.main()
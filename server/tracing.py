@@ -0,0 +1,167 @@
+"""Request tracing
+
+Opt-in timing of request parsing, handling and lock waits per request type
+with a ring buffer of slow requests and failures for the trace command.
+"""
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from metrics import REGISTRY
+
+
+class Tracer:
+    """Tracer class
+    Times requests on the threads that call begin and finish
+
+    Parameters:
+    slow_threshold: float
+        Requests taking at least this many seconds are sampled
+    size: int
+        Number of samples the ring buffer holds
+    """
+
+    def __init__(self, slow_threshold: float = 0.01, size: int = 64):
+        self.enabled = False
+        self.slow_threshold = slow_threshold
+        self.samples = deque(maxlen=size)
+        self.errors = deque(maxlen=size)
+        self.local = threading.local()
+        self.parse_time = REGISTRY.histogram_family("request_parse_seconds", "type")
+        self.handler_time = REGISTRY.histogram_family("request_handler_seconds", "type")
+        self.lock_wait = REGISTRY.histogram_family("request_lock_wait_seconds", "type")
+
+    def enable(self, slow_threshold: float = None):
+        """Turns tracing on
+        """
+        if slow_threshold is not None:
+            self.slow_threshold = slow_threshold
+        self.enabled = True
+
+    def disable(self):
+        """Turns tracing off
+        """
+        self.enabled = False
+
+    def begin(self):
+        """Starts tracing a request on the current thread
+        """
+        self.local.active = True
+        self.local.stack = []
+        self.local.holds = []
+
+    def finish(self, request: str, parse: float, handler: float, addr):
+        """Records a finished request
+        Parameters:
+        request: str
+            The request type
+        parse: float
+            Seconds spent decoding the packet
+        handler: float
+            Seconds spent in the request handler
+        addr: pair(str, int)
+            Where the request came from
+        """
+        holds = getattr(self.local, "holds", [])
+        self.local.active = False
+        wait = sum(hold[1] for hold in holds)
+        self.parse_time.labels(request).observe(parse)
+        self.handler_time.labels(request).observe(handler)
+        self.lock_wait.labels(request).observe(wait)
+        if parse + handler >= self.slow_threshold:
+            self.samples.append((datetime.now(), request, addr, parse, handler, wait, holds))
+
+    def error(self, request: str, addr, trace: str):
+        """Records a failed request
+        Parameters:
+        request: str
+            The request type, may be None if the packet could not be parsed
+        addr: pair(str, int)
+            Where the request came from
+        trace: str
+            The formatted traceback
+        """
+        self.local.active = False
+        self.errors.append((datetime.now(), request, addr, trace))
+
+    def lock_acquired(self, name: str, wait: float, acquired: float):
+        """Called by TracedLock after acquiring
+        """
+        if getattr(self.local, "active", False):
+            self.local.stack.append((name, wait, acquired))
+
+    def lock_released(self, name: str):
+        """Called by TracedLock before releasing
+        """
+        if not getattr(self.local, "active", False):
+            return
+        stack = self.local.stack
+        for index in range(len(stack) - 1, -1, -1):
+            if stack[index][0] == name:
+                (_, wait, acquired) = stack.pop(index)
+                self.local.holds.append((name, wait, time.perf_counter() - acquired))
+                return
+
+    def dump(self) -> str:
+        """Returns the sampled slow requests and failures as text
+        """
+        lines = [f'-=SLOW REQUESTS (>= {self.slow_threshold * 1000:.2f}ms)=-']
+        for (stamp, request, addr, parse, handler, wait, holds) in list(self.samples):
+            lines.append(f'{stamp:%H:%M:%S.%f} {request} from {addr} parse={parse * 1000:.3f}ms '
+                         f'handler={handler * 1000:.3f}ms lock-wait={wait * 1000:.3f}ms')
+            for (name, lock_wait, held) in holds:
+                lines.append(f'    {name}: waited {lock_wait * 1000:.3f}ms '
+                             f'held {held * 1000:.3f}ms')
+        lines.append('-=FAILED REQUESTS=-')
+        for (stamp, request, addr, trace) in list(self.errors):
+            lines.append(f'{stamp:%H:%M:%S.%f} {request} from {addr}')
+            lines.append(trace.rstrip())
+        return "\n".join(lines)
+
+
+TRACER = Tracer()
+
+
+class TracedLock:
+    """TracedLock class
+    Reentrant lock that reports wait and hold times to a tracer when it is enabled
+
+    Parameters:
+    name: str
+        Name shown in traces
+    tracer: Tracer
+        The tracer to report to
+    """
+    __slots__ = ("name", "tracer", "lock")
+
+    def __init__(self, name: str, tracer: Tracer = TRACER):
+        self.name = name
+        self.tracer = tracer
+        self.lock = threading.RLock()
+
+    def acquire(self, blocking=True, timeout=-1):
+        """Acquires the lock
+        """
+        if not self.tracer.enabled:
+            return self.lock.acquire(blocking, timeout)
+        start = time.perf_counter()
+        result = self.lock.acquire(blocking, timeout)
+        if result:
+            acquired = time.perf_counter()
+            self.tracer.lock_acquired(self.name, acquired - start, acquired)
+        return result
+
+    def release(self):
+        """Releases the lock
+        """
+        if self.tracer.enabled:
+            self.tracer.lock_released(self.name)
+        self.lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
@@ -1,17 +1,32 @@
 """ Utility Classes
 """
-from datetime import datetime, timedelta
+import math
+from clock import CLOCK
 
 class Timer():
     """ Delta Timer class
+    Samples the clock on every get_delta
     """
-    def __init__(self):
-        self.last_loop = datetime.now()
+    def __init__(self, clock=CLOCK):
+        self.clock = clock
+        self.last_loop = clock.sample()
 
-    def get_delta(self) -> timedelta:
-        """ Returns the delta
+    def get_delta(self) -> float:
+        """ Returns the seconds since the last call
         """
-        time = datetime.now()
+        time = self.clock.sample()
         delta = time - self.last_loop
         self.last_loop = time
         return delta
+
+
+def is_finite_number(value) -> bool:
+    """ Returns whether a decoded json value is a finite int or float
+    Booleans and ints too large for a float are not numbers here
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return False
+    try:
+        return math.isfinite(value)
+    except OverflowError:
+        return False
@@ -1,28 +1,120 @@
 import threading
 import socket
+import itertools
+from collections import deque
 
 try:
-    #import asyncio
-    asyncio = None
+    import asyncio
 except ImportError:
     asyncio = None
 try:
-    #import websockets
-    websockets = None
+    import websockets
 except ImportError:
     websockets = None
 
 from server import ServerThread
+from metrics import REGISTRY
+
+
+class Outbound:
+    """Outbound class
+    Bounded frames waiting to be written to a single WebSocket connection
+    Only touched from the relay's event loop
+
+    Frames pushed with a supersede key replace a queued frame with the same key
+    in place, so a slow connection only ever holds the latest state update.
+    The writer sends one frame at a time and the connection's write limit makes
+    each send wait while the transport buffer is above the high-water mark.
+
+    Parameters:
+    websocket: WebSocketServerProtocol
+        The connection to write to
+    max_frames: int
+        Frames held before the oldest is dropped
+    lag_threshold: float
+        Seconds the oldest frame may wait before the connection is closed
+    """
+    sequence = itertools.count()
+    coalesced = REGISTRY.counter("ws_frames_coalesced_total")
+    dropped = REGISTRY.counter("ws_frames_dropped_total")
+    lagging = REGISTRY.counter("ws_lag_disconnects_total")
+
+    def __init__(self, websocket, max_frames: int = 256, lag_threshold: float = 5.0):
+        self.websocket = websocket
+        self.max_frames = max_frames
+        self.lag_threshold = lag_threshold
+        self.frames = {}
+        self.ready = asyncio.Event()
+        self.closing = False
+
+    def push(self, frame: bytes, key=None):
+        """Queues a frame and wakes the writer
+        Parameters:
+        frame: bytes
+            The data to send
+        key: Any
+            Frames with the same key supersede each other, None never supersedes
+        """
+        if self.closing:
+            return
+        now = asyncio.get_running_loop().time()
+        if key is None:
+            key = next(self.sequence)
+        elif key in self.frames:
+            self.frames[key] = (self.frames[key][0], frame)
+            self.coalesced.inc()
+            return
+        if len(self.frames) >= self.max_frames:
+            self.frames.pop(next(iter(self.frames)))
+            self.dropped.inc()
+        self.frames[key] = (now, frame)
+        self.ready.set()
+        if now - next(iter(self.frames.values()))[0] > self.lag_threshold:
+            self.closing = True
+            self.lagging.inc()
+            print(f"Closing lagging websocket client {self.websocket.remote_address}")
+            asyncio.create_task(self.websocket.close(1013, "Too far behind"))
+
+    async def drain(self):
+        """Writes queued frames until the connection closes
+        """
+        try:
+            while True:
+                await self.ready.wait()
+                self.ready.clear()
+                while self.frames:
+                    (_, frame) = self.frames.pop(next(iter(self.frames)))
+                    await self.websocket.send(frame)
+        except websockets.ConnectionClosed:
+            self.closing = True
+
 
 class WebSocketServer(threading.Thread):
     """WebSocketServer thread for transporting websockets to local udp
+    Sends from other threads are handed to this thread's event loop
+
+    Parameters:
+    max_frames: int
+        Frames queued per connection before the oldest is dropped
+    high_water: int
+        Transport write buffer size in bytes above which sends wait
+    lag_threshold: float
+        Seconds a queued frame may wait before its connection is closed
     """
-    def __init__(self, server: ServerThread, port: int, name: str = "wssthread"):
+    def __init__(self, server: ServerThread, port: int, max_frames: int = 256,
+                 high_water: int = 65536, lag_threshold: float = 5.0, name: str = "wssthread"):
         super(WebSocketServer, self).__init__(name = name)
-        
+        self.max_frames = max_frames
+        self.high_water = high_water
+        self.lag_threshold = lag_threshold
+
         self.server = server
         self.port = port
         self.clients = {}
+        self.outbound = {}
+        self.pending = deque()
+        self.wakeup = False
+        self.loop = None
         self.running = True
         self.block = None
         self.daemon = True
@@ -32,42 +124,80 @@ class WebSocketServer(threading.Thread):
     def run(self):
         print("Starting WebSocket Relay...")
         if websockets and asyncio:
-            self.block = asyncio.Event()
             asyncio.run(self.run_socket())
         else:
             message = ["asyncio" if not asyncio else "","websockets" if not websockets else ""]
             print(f'missing modules {", ".join(message)}')
-        #self.ws = websockets.serve(self.redirect, self.server.ip, self.port)
+
+    def send(self, addr, frame: bytes, key=None) -> bool:
+        """Queues a frame for a WebSocket client from any thread
+        The loop is only woken once per batch of sends
+        Parameters:
+        addr: pair(str, int)
+            The address of the WebSocket client
+        frame: bytes
+            The data to send
+        key: Any
+            Optional supersede key, see Outbound.push
+        """
+        loop = self.loop
+        if loop is None or addr not in self.clients:
+            return False
+        self.pending.append((addr, frame, key))
+        if not self.wakeup:
+            self.wakeup = True
+            loop.call_soon_threadsafe(self.dispatch)
+        return True
+
+    def dispatch(self):
+        """Moves pending frames onto each connection's outbound queue
+        Runs on the event loop
+        """
+        self.wakeup = False
+        while self.pending:
+            (addr, frame, key) = self.pending.popleft()
+            outbound = self.outbound.get(addr)
+            if outbound is not None:
+                outbound.push(frame, key)
 
     async def redirect(self, websocket):
         """Redirects WebSocket messages to the udp server
         """
         client = websocket.remote_address
-        self.clients[(client[0], client[1])] = websocket
+        addr = (client[0], client[1])
+        outbound = Outbound(websocket, self.max_frames, self.lag_threshold)
+        self.outbound[addr] = outbound
+        self.clients[addr] = websocket
+        writer = asyncio.create_task(outbound.drain())
         try:
             async for message in websocket:
-                self.server.process_websocket_message(message, (client[0],client[1]))
+                self.server.process_websocket_message(message, addr)
+        except websockets.ConnectionClosed:
+            pass
         finally:
             print("Websocket client disconnected")
-            del self.clients[(client[0],client[1])]
-
+            writer.cancel()
+            self.clients.pop(addr, None)
+            self.outbound.pop(addr, None)
 
     async def run_socket(self):
         """Runs the websocket server
         """
-
-        #loop = asyncio.get_running_loop()
-        #self.stop_event.set_result(None)
-    
-        async with websockets.serve(self.redirect, self.server.ip, self.port, family=socket.AF_INET) as ws:
+        self.loop = asyncio.get_running_loop()
+        self.block = asyncio.Event()
+        async with websockets.serve(self.redirect, self.server.ip, self.port, family=socket.AF_INET,
+                                    write_limit=self.high_water) as ws:
             self.ws = ws
             try:
                 await self.block.wait()
             finally:
-                ws.close() 
+                ws.close()
+        self.loop = None
 
     def stop(self):
         """Stops the websocket server
         """
-        self.block.set()
         self.running = False
+        loop = self.loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self.block.set)
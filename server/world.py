@@ -1,21 +1,151 @@
 """World related classes
 """
+import itertools
+import json
 import threading
 import time
+from collections import deque, namedtuple
+from types import MappingProxyType
 
 from math2 import Vector
-from messagebuilder import MessageRelay
+from messagebuilder import MessageRelay, RELIABLE_OVERHEAD
+from fragments import MAX_DATAGRAM
 from clienthandler import ClientThread
-import utils
+from metrics import REGISTRY
+from chat import ChatRouter
+from tracing import TracedLock
+from clock import CLOCK
+
+
+EntitySnapshot = namedtuple(
+    "EntitySnapshot", ["id", "name", "chunk_x", "chunk_y", "x", "y", "vel_x", "vel_y", "addr"])
+
+
+class WorldSnapshot:
+    """WorldSnapshot class
+    Immutable view of the world published at the end of a tick
+    Safe to read from any thread without taking the world lock
+    Parameters:
+    tick: int
+        The tick this snapshot was published on
+    by_id: dict
+        The EntitySnapshot of every client in the world by client id, owned by
+        this snapshot once passed in
+    """
+    __slots__ = ("tick", "by_id")
+
+    def __init__(self, tick: int = 0, by_id: dict = None):
+        self.tick = tick
+        self.by_id = MappingProxyType(by_id if by_id is not None else {})
+
+    def get(self, cid):
+        """Returns the EntitySnapshot for a client id or None
+        """
+        return self.by_id.get(cid)
+
+    def list_players(self):
+        """Returns a map of every client name to its id
+        """
+        return {e.name.lower(): e.id for e in self.by_id.values()}
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def __iter__(self):
+        return iter(self.by_id.values())
+
+
+class SnapshotStream:
+    """SnapshotStream class
+    Pages of a world snapshot being streamed to one client
+    Paced by the world thread and resumed from the last acknowledged page
+
+    Parameters:
+    sid: int
+        Id of this stream, echoed in every page
+    target: Client
+        The client receiving the pages
+    pages: list[list[dict]]
+        The entries of each page
+    tick: int
+        The tick the stream was created on
+    """
+    __slots__ = ("sid", "target", "pages", "next", "acked", "last_sent", "resends")
+
+    def __init__(self, sid: int, target, pages: list, tick: int):
+        self.sid = sid
+        self.target = target
+        self.pages = pages
+        self.next = 0
+        self.acked = 0
+        self.last_sent = tick
+        self.resends = 0
+
+    def ack(self, count: int):
+        """Marks the first count pages as received
+        """
+        if count > self.acked:
+            self.acked = min(count, len(self.pages))
+
+    def done(self) -> bool:
+        """Returns whether every page has been acknowledged
+        """
+        return self.acked >= len(self.pages)
 
 
 class World(threading.Thread):
     """ World class
+
+    Joins and leaves are collected into a presence delta each tick, a join and
+    leave of the same client within one tick cancel out, and every client gets
+    at most one presence message per tick. When presence_radius is set every
+    client is told about the clients within that many chunks of it instead: a
+    client is announced as joined when it comes into range, including by
+    logging in, and as left when it goes out of range or logs out.
+
+    Join snapshots, presence deltas and chat lines are sent in pages that fit
+    one datagram with their message around them, or of at most page_bytes
+    when it is set. Join snapshots are limited to chunks within aoi_radius
+    of the joiner. Each tick a stream sends up to
+    pages_per_tick pages while fewer than window pages are unacknowledged,
+    and resumes from the last acknowledged page after resend_ticks.
+
+    Chunks are created the first time a client enters them. Each chunk
+    indexes its clients in cells of cell_size, query_radius and query_rect
+    use them to find clients near a point across chunk borders.
+
+    Chunks holding at least one moving client are kept in active_chunks and
+    only those are simulated, each exactly once per tick. Velocity changes go
+    through set_velocity so the set is only maintained by the world thread.
+
+    Velocities are in units per tick. With dead_reckoning on, a client's
+    position, velocity and tick are only sent when its velocity changes or
+    when the position clients extrapolate from the last update drifts more
+    than drift_threshold units from the simulated one. Clients extrapolate at
+    tps ticks per second of wall clock time, so ticks are scheduled at a fixed
+    rate and drift is measured against the clock.
+
+    With no movers, streams or queued work the whole loop drops to idle_tps
+    and wakes as soon as something is queued.
+
+    With a checkpointer, clients that moved are collected every
+    checkpoint_interval seconds and on logout and handed to it to be written
+    in the background. Callers load a client's saved position from it before
+    add_client, so no lock is held while the database is read.
+
+    The clock is sampled once at the start of every tick and ticks wait on
+    it, so on a virtual clock the world drives time forward tick by tick.
     """
+    stream_ids = itertools.count(1)
 
     def __init__(self, name: str, message_handler: MessageRelay, client_handler: ClientThread,
                  width: int, height: int, chunk_width: int = 400, chunk_height: int = 400,
-                 spawn_point: Vector = None, tps=20, threadname="worldthread"):
+                 spawn_point: Vector = None, tps=20, aoi_radius: int = 2,
+                 page_bytes: int = None, pages_per_tick: int = 2, window: int = 4,
+                 resend_ticks: int = 20, max_resends: int = 5, presence_radius: int = None,
+                 chat_radius: int = 1, cell_size: int = 50, dead_reckoning: bool = True,
+                 drift_threshold: float = 8.0, idle_tps: float = 2, checkpointer=None, checkpoint_interval: float = 10.0,
+                 clock=CLOCK, threadname="worldthread"):
         super(World, self).__init__(name=threadname)
         self.name = name
         self.message_handler = message_handler
@@ -24,59 +154,253 @@ class World(threading.Thread):
         self.height = height
         self.chunk_width = chunk_width
         self.chunk_height = chunk_height
-        self.chunks = [[]]
-        self.active_chunks = []
+        self.cell_size = cell_size
+        self.chunks = {}
+        self.active_chunks = set()
+        self.idle_tps = idle_tps
+        self.wakeup = threading.Event()
+        self.active_gauge = REGISTRY.gauge("active_chunks")
         self.clients = {}
-        self.moved_clients = []
+        self.moved_clients = set()
+        self.reckoned = {}
+        self.checkpointer = checkpointer
+        self.checkpoint_interval = checkpoint_interval
+        self.clock = clock
+        self.next_checkpoint = clock.sample() + checkpoint_interval
+        self.unsaved = set()
+        self.dead_reckoning = dead_reckoning
+        self.drift_threshold = drift_threshold
+        self.corrections = REGISTRY.counter("position_corrections_total")
+        self.pending = deque()
+        self.changed = set()
+        self.tick = 0
+        self.tick_time = REGISTRY.histogram("tick_seconds")
+        self.snapshot = WorldSnapshot()
+        self.streams = {}
+        self.joined = {}
+        self.left = set()
+        self.presence_radius = presence_radius
+        self.known = {}
+        self.crossed = False
+        self.chat = ChatRouter(self, chat_radius)
+        self.aoi_radius = aoi_radius
+        self.page_bytes = page_bytes
+        self.pages_per_tick = pages_per_tick
+        self.window = window
+        self.resend_ticks = resend_ticks
+        self.max_resends = max_resends
         if spawn_point is not None:
             self.spawn_point = spawn_point
         else:
-            self.spawn_point = [0, 0]
-        self.lock = threading.RLock()
+            self.spawn_point = [int(self.width/2), int(self.height/2)]
+        self.lock = TracedLock("world")
         self.running = True
         self.tps = tps
-        self.timer = utils.Timer()
-        self.delta = 1-self.timer.get_delta().total_seconds()
         self.start()
 
     def run(self):
         print("Starting World Handler")
-        with self.lock:
-            self.chunks = self.create_empty_world()
-            self.spawn_point = [int(self.width/2), int(self.height/2)]
+        period = 1.0 / self.tps
+        deadline = self.clock.sample()
         while self.running:
+            start = time.perf_counter()
+            now = self.clock.sample()
             with self.lock:
-                self.delta = 1-self.timer.get_delta().total_seconds()
-                for chunk in self.clients.items():
-                    chunk[1].update_clients()
+                self.apply_pending()
+                self.simulate()
+                if self.moved_clients:
+                    self.changed.update(self.moved_clients)
+                    self.unsaved.update(self.moved_clients)
                 self.send_positions()
-                time.sleep(1.0/self.tps)
+                self.send_presence()
+                self.chat.flush()
+                self.advance_streams()
+                self.tick += 1
+                if self.changed:
+                    self.publish_snapshot()
+                if self.unsaved and now >= self.next_checkpoint:
+                    self.checkpoint()
+                    self.next_checkpoint = now + self.checkpoint_interval
+            self.message_handler.request_flush()
+            self.tick_time.observe(time.perf_counter() - start)
+            self.active_gauge.set(len(self.active_chunks))
+            if self.active_chunks or self.streams or self.pending:
+                # Ticks are scheduled at a fixed rate, a late tick shortens the next wait
+                deadline = max(deadline + period, now)
+                delay = deadline - self.clock.sample()
+                if delay > 0:
+                    self.clock.sleep(delay)
+                continue
+            self.wakeup.clear()
+            if not self.pending:
+                self.clock.wait(self.wakeup, 1.0/self.idle_tps)
+            deadline = self.clock.sample()
+        with self.lock:
+            self.checkpoint()
 
-    def create_empty_world(self):
-        """Generates a bunch of empty chunks
+    def apply_pending(self):
+        """Applies client additions and removals queued by other threads
+        Only called from the world thread
         """
-        chunks = []
-        for y in range(0, self.height):
-            chunks.append([])
-            for x in range(0, self.width):
-                chunk = Chunk(self, x, y, self.chunk_width, self.chunk_height)
-                chunks[y].append(chunk)
-        return chunks
+        while self.pending:
+            (op, item) = self.pending.popleft()
+            if op == "add":
+                self.add_client_now(item)
+                self.joined[item.id] = item
+                self.changed.add(item)
+            elif op == "velocity":
+                self.apply_velocity(*item)
+                continue
+            elif op == "stream":
+                self.streams[item.target.id] = item
+                continue
+            elif op == "chat":
+                self.chat.route(*item)
+                continue
+            elif op == "room-join":
+                self.chat.join_room(*item)
+                continue
+            elif op == "room-leave":
+                self.chat.leave_room(*item)
+                continue
+            else:
+                self.remove_client_now(item)
+                if self.joined.pop(item.id, None) is None:
+                    self.left.add(item.id)
+                self.changed.add(item)
 
-    def add_client(self, client):
+    def simulate(self):
+        """Moves the clients of every active chunk once
+        Movers are collected up front so a client crossing into a chunk that
+        is simulated later in the tick is not moved twice
+        Only called from the world thread
+        """
+        batch = [(chunk, c) for chunk in self.active_chunks for c in chunk.moving]
+        for (chunk, c) in batch:
+            chunk.update_client(c)
+
+    def apply_velocity(self, client, vel):
+        """Sets a client's velocity and updates its chunk's moving set
+        Only called from the world thread
+        """
+        client.move(vel)
+        client.moving = client.vel_x != 0 or client.vel_y != 0
+        chunk = self.clients.get(client)
+        if chunk is not None:
+            chunk.update_moving(client)
+            self.moved_clients.add(client)
+
+    def checkpoint(self):
+        """Hands the positions of clients that moved since the last checkpoint
+        to the checkpointer
+        Only called from the world thread
+        """
+        if self.checkpointer is not None and self.unsaved:
+            self.checkpointer.submit([self.position_row(c) for c in self.unsaved])
+        self.unsaved.clear()
+
+    @staticmethod
+    def position_row(client) -> tuple:
+        """Returns the checkpoint row of a client
+        """
+        return (client.id.bytes, client.chunk_x, client.chunk_y, client.x, client.y)
+
+    def publish_snapshot(self):
+        """Publishes an immutable snapshot of the live state
+        Entries of clients that did not change are reused from the last snapshot,
+        only changed, joined and removed clients are rebuilt
+        """
+        by_id = dict(self.snapshot.by_id)
+        for c in self.changed:
+            if c not in self.clients:
+                by_id.pop(c.id, None)
+        for c in self.changed:
+            if c in self.clients:
+                by_id[c.id] = EntitySnapshot(
+                    c.id, c.name, c.chunk_x, c.chunk_y, c.x, c.y, c.vel_x, c.vel_y, c.get_addr())
+        self.snapshot = WorldSnapshot(self.tick, by_id)
+        self.changed.clear()
+
+    def get_snapshot(self) -> WorldSnapshot:
+        """Returns the last published snapshot
+        Does not wait for a lock
+        """
+        return self.snapshot
+
+    def get_chunk(self, x: int, y: int):
+        """Returns the chunk at x, y, creating it the first time it is used
+        Chunks that were never entered are not created, use chunks.get((x, y))
+        to look one up without creating it
+        """
+        chunk = self.chunks.get((x, y))
+        if chunk is None:
+            chunk = Chunk(self, x, y, self.chunk_width, self.chunk_height, self.cell_size)
+            self.chunks[(x, y)] = chunk
+        return chunk
+
+    def add_client(self, client, position: tuple = None):
+        """Queues an active client to be added on the next tick
+        Places it at position if that is valid, at the spawn point otherwise
+        position: tuple
+            Optional (chunk_x, chunk_y, x, y) to place the client at
+        """
+        saved = position
+        if (saved is not None and 0 <= saved[0] < self.width and 0 <= saved[1] < self.height
+                and 0 <= saved[2] < self.chunk_width and 0 <= saved[3] < self.chunk_height):
+            (client.chunk_x, client.chunk_y, client.x, client.y) = saved
+        else:
+            client.chunk_x = self.spawn_point[0]
+            client.chunk_y = self.spawn_point[1]
+        self.queue("add", client)
+
+    def remove_client(self, client):
+        """Queues an active client to be removed on the next tick
+        """
+        self.queue("remove", client)
+
+    def set_velocity(self, client, vel):
+        """Queues a velocity change to be applied on the next tick
+        A zero velocity stops the client
+        """
+        self.queue("velocity", (client, vel))
+
+    def post_chat(self, client, channel: str, text: str, room: str = None):
+        """Queues a chat line to be routed on the next tick
+        """
+        self.queue("chat", (client, channel, text, room))
+
+    def join_room(self, client, room: str):
+        """Queues subscribing a client to a chat room
+        """
+        self.queue("room-join", (client, room))
+
+    def leave_room(self, client, room: str):
+        """Queues unsubscribing a client from a chat room
+        """
+        self.queue("room-leave", (client, room))
+
+    def add_client_now(self, client):
         """Adds active client
         """
         with self.lock:
-            chunk = self.chunks[self.spawn_point[1]][self.spawn_point[0]]
+            chunk = self.get_chunk(client.chunk_x, client.chunk_y)
             self.clients[client] = chunk
             chunk.add_client(client)
 
-    def remove_client(self, client):
+    def remove_client_now(self, client):
         """Removes active client
         """
         with self.lock:
-            self.clients.get(client).remove_client(client)
-            self.clients.pop(client, None)
+            chunk = self.clients.pop(client, None)
+            if chunk is not None:
+                chunk.remove_client(client)
+                if self.checkpointer is not None:
+                    self.checkpointer.submit([self.position_row(client)])
+            self.unsaved.discard(client)
+            self.streams.pop(client.id, None)
+            self.chat.remove_client(client)
+            self.reckoned.pop(client, None)
+            self.moved_clients.discard(client)
 
     def move_client(self, client, x, y) -> bool:
         """Moves a client to a new chunk
@@ -84,53 +408,240 @@ class World(threading.Thread):
         if x < 0 or x >= self.width or y < 0 or y >= self.height:
             return False
         with self.lock:
-            if client.chunk[0] == x and client.chunk[1] == y:
-                self.moved_clients.append(client)
+            if client.chunk_x == x and client.chunk_y == y:
+                self.moved_clients.add(client)
                 return True
             c_chunk = self.clients[client]
-            new_chunk = self.chunks[int(y)][int(x)]
+            new_chunk = self.get_chunk(int(x), int(y))
 
             c_chunk.remove_client(client)
             new_chunk.add_client(client)
 
-            client.set_pos([client.pos[0] % self.chunk_width,
-                           client.pos[1] % self.chunk_height])
+            client.x %= self.chunk_width
+            client.y %= self.chunk_height
 
-            client.chunk = [int(new_chunk.x), int(new_chunk.y)]
+            client.chunk_x = int(new_chunk.x)
+            client.chunk_y = int(new_chunk.y)
             self.clients[client] = new_chunk
-            self.moved_clients.append(client)
+            self.moved_clients.add(client)
+            self.crossed = True
             return True
 
+    def query_rect(self, x0, y0, x1, y1) -> list:
+        """Returns the clients inside a rectangle in world coordinates
+        Works across chunk boundaries
+        Call from the world thread or while holding the world lock
+        """
+        (cw, ch) = (self.chunk_width, self.chunk_height)
+        candidates = []
+        for cy in range(max(0, int(y0 // ch)), min(self.height - 1, int(y1 // ch)) + 1):
+            for cx in range(max(0, int(x0 // cw)), min(self.width - 1, int(x1 // cw)) + 1):
+                chunk = self.chunks.get((cx, cy))
+                if chunk is not None and chunk.clients:
+                    chunk.query_rect(x0 - cx * cw, y0 - cy * ch, x1 - cx * cw, y1 - cy * ch,
+                                     candidates)
+        return [c for c in candidates
+                if x0 <= c.chunk_x * cw + c.x <= x1 and y0 <= c.chunk_y * ch + c.y <= y1]
+
+    def query_radius(self, x, y, radius) -> list:
+        """Returns the clients within radius of a point in world coordinates
+        Works across chunk boundaries
+        Call from the world thread or while holding the world lock
+        """
+        (cw, ch) = (self.chunk_width, self.chunk_height)
+        squared = radius * radius
+        return [c for c in self.query_rect(x - radius, y - radius, x + radius, y + radius)
+                if (c.chunk_x * cw + c.x - x) ** 2 + (c.chunk_y * ch + c.y - y) ** 2 <= squared]
+
     def send_positions(self):
         """Updates all connected clients
+        With dead reckoning only clients that need a correction are sent
         """
         with self.lock:
+            updates = [up for up in self.moved_clients
+                       if not self.dead_reckoning or self.needs_correction(up)]
+            self.moved_clients.clear()
+            for up in updates:
+                self.reckoned[up] = (self.clock.now(), up.chunk_x * self.chunk_width + up.x,
+                                     up.chunk_y * self.chunk_height + up.y, up.vel_x, up.vel_y)
             for client in self.clients:
-                for up in self.moved_clients:
+                for up in updates:
                     self.send_client_position_to(up, client)
-            self.moved_clients.clear()
+
+    def needs_correction(self, client) -> bool:
+        """Returns whether the position clients extrapolate for a client is stale
+        True when its velocity changed since the last update or the extrapolated
+        position is more than drift_threshold from the simulated one
+        """
+        state = self.reckoned.get(client)
+        if state is None:
+            return True
+        (sent, x, y, vel_x, vel_y) = state
+        if vel_x != client.vel_x or vel_y != client.vel_y:
+            return True
+        # Clients extrapolate by wall clock time at the nominal tick rate
+        elapsed = (self.clock.now() - sent) * self.tps
+        drift_x = x + vel_x * elapsed - (client.chunk_x * self.chunk_width + client.x)
+        drift_y = y + vel_y * elapsed - (client.chunk_y * self.chunk_height + client.y)
+        if drift_x * drift_x + drift_y * drift_y > self.drift_threshold * self.drift_threshold:
+            self.corrections.inc()
+            return True
+        return False
 
     def full_update(self, target):
-        """Fully updates all logged in clients
+        """Streams the clients around the target to it in pages
+        Reads from the published snapshot so it never waits on the tick
+        Returns the stream id
         """
-        with self.lock:
-            for client in self.clients:
-                self.send_full_client_to(client, target)
+        pages = self.build_pages(self.snapshot, target)
+        stream = SnapshotStream(next(self.stream_ids), target, pages, self.tick)
+        self.queue("stream", stream)
+        return stream.sid
 
-    def send_full_client_to(self, client, target):
-        """Sends full client information to the target
+    def build_pages(self, snapshot: WorldSnapshot, target):
+        """Splits the entities near the target into snapshot pages
         """
-        with self.lock:
-            to_send = {
-                "response": "client-update",
-                "client-id": str(client.id),
-                "client-name": client.name,
-                "chunk-x": client.chunk[0],
-                "chunk-y": client.chunk[1],
-                "x": client.pos[0],
-                "y": client.pos[1]
-            }
-            self.message_handler.send_message(target.get_addr(), to_send, 1)
+        (cx, cy, radius) = (target.chunk_x, target.chunk_y, self.aoi_radius)
+        return self.paginate([
+            self.describe(entity) for entity in snapshot
+            if abs(entity.chunk_x - cx) <= radius and abs(entity.chunk_y - cy) <= radius], {
+                "response": "snapshot-page",
+                "snapshot": 2 ** 31,
+                "page": 99999,
+                "pages": 99999,
+                "clients": []
+            })
+
+    def paginate(self, entries: list, envelope: dict):
+        """Splits json serializable entries into pages that fit one datagram
+        Always returns at least one page
+        Parameters:
+        entries: list
+            The entries to split
+        envelope: dict
+            The message a page is sent in with an empty page, counters at their widest
+        """
+        budget = self.page_bytes or max(
+            256, MAX_DATAGRAM - RELIABLE_OVERHEAD - len(json.dumps(envelope)))
+        pages = [[]]
+        size = 0
+        for entry in entries:
+            entry_size = len(json.dumps(entry)) + 2
+            if pages[-1] and size + entry_size > budget:
+                pages.append([])
+                size = 0
+            pages[-1].append(entry)
+            size += entry_size
+        return pages
+
+    @staticmethod
+    def describe(entity) -> dict:
+        """Returns the compact description of a client or entity snapshot
+        """
+        return {
+            "id": str(entity.id),
+            "name": entity.name,
+            "cx": entity.chunk_x,
+            "cy": entity.chunk_y,
+            "x": round(entity.x, 2),
+            "y": round(entity.y, 2)
+        }
+
+    def send_presence(self):
+        """Sends this tick's joins and leaves as one message per client
+        Only called from the world thread
+        """
+        if self.presence_radius is not None:
+            if self.joined or self.left or self.crossed:
+                self.send_presence_in_range()
+            return
+        if not self.joined and not self.left:
+            return
+        joined = list(self.joined.values())
+        left = [str(cid) for cid in self.left]
+        self.joined.clear()
+        self.left.clear()
+        pages = self.paginate([self.describe(c) for c in joined],
+                              {"response": "presence", "joined": [], "left": left})
+        for target in self.clients:
+            self.send_presence_pages(target, pages, left)
+
+    def send_presence_in_range(self):
+        """Tells every client which clients came into and went out of presence_radius
+        Only called from the world thread
+        """
+        self.joined.clear()
+        self.left.clear()
+        self.crossed = False
+        radius = self.presence_radius
+        for target in list(self.known):
+            if target not in self.clients:
+                del self.known[target]
+        for target in self.clients:
+            in_range = {}
+            for cy in range(target.chunk_y - radius, target.chunk_y + radius + 1):
+                for cx in range(target.chunk_x - radius, target.chunk_x + radius + 1):
+                    chunk = self.chunks.get((cx, cy))
+                    if chunk is not None:
+                        in_range.update((c.id, c) for c in chunk.clients)
+            known = self.known.get(target, set())
+            entered = [c for (cid, c) in in_range.items() if cid not in known]
+            left = [str(cid) for cid in known if cid not in in_range]
+            self.known[target] = set(in_range)
+            if not entered and not left:
+                continue
+            pages = self.paginate([self.describe(c) for c in entered],
+                                  {"response": "presence", "joined": [], "left": left})
+            self.send_presence_pages(target, pages, left)
+
+    def send_presence_pages(self, target, pages: list, left: list):
+        """Sends presence pages to a client, the leaves go with the first page
+        """
+        for (index, page) in enumerate(pages):
+            self.message_handler.send_message(target.get_addr(), {
+                "response": "presence",
+                "joined": page,
+                "left": left if index == 0 else []
+            })
+
+    def ack_stream(self, target, sid: int, count: int) -> bool:
+        """Records that the target has received the first count pages of a stream
+        """
+        stream = self.streams.get(target.id)
+        if stream is None or stream.sid != sid:
+            return False
+        stream.ack(count)
+        return True
+
+    def advance_streams(self):
+        """Sends the next pages of every snapshot stream
+        Only called from the world thread
+        """
+        for (cid, stream) in list(self.streams.items()):
+            if stream.done():
+                del self.streams[cid]
+                continue
+            if stream.next - stream.acked >= self.window or stream.next >= len(stream.pages):
+                if self.tick - stream.last_sent < self.resend_ticks:
+                    continue
+                if stream.resends >= self.max_resends:
+                    del self.streams[cid]
+                    continue
+                stream.resends += 1
+                stream.next = stream.acked
+            end = min(len(stream.pages), stream.next + self.pages_per_tick,
+                      stream.acked + self.window)
+            for page in range(stream.next, end):
+                self.message_handler.send_message(stream.target.get_addr(), {
+                    "response": "snapshot-page",
+                    "snapshot": stream.sid,
+                    "page": page,
+                    "pages": len(stream.pages),
+                    "clients": stream.pages[page]
+                }, 1, supersede=("snapshot", stream.sid, page))
+            if end > stream.next:
+                stream.next = end
+                stream.last_sent = self.tick
 
     def send_client_position_to(self, client, target):
         """Sends client position to a target
@@ -139,22 +650,35 @@ class World(threading.Thread):
             to_send = {
                 "response": "position-update",
                 "target": str(client.id),
-                "new-chunk-x": client.chunk[0],
-                "new-chunk-y": client.chunk[1],
-                "new-x": client.pos[0],
-                "new-y": client.pos[1]
+                "new-chunk-x": client.chunk_x,
+                "new-chunk-y": client.chunk_y,
+                "new-x": round(client.x, 2),
+                "new-y": round(client.y, 2),
+                "vel-x": client.vel_x,
+                "vel-y": client.vel_y,
+                "tick": self.tick
             }
-            self.message_handler.send_message(target.get_addr(), to_send, 1)
+            self.message_handler.send_message(target.get_addr(), to_send, 1,
+                                              supersede=("position", client.id))
+
+    def queue(self, op: str, item):
+        """Queues an operation for the world thread and wakes it if idle
+        """
+        self.pending.append((op, item))
+        self.wakeup.set()
 
     def stop(self):
         """ Stops this thread
         """
         self.running = False
+        self.wakeup.set()
 
 
 class Chunk:
     """Chunk class
     Wraps chunk information
+    Occupants are kept in an insertion ordered dict and a spatial hash of
+    cell_size square cells that is updated as clients move
     Parameters:
     world: World
         World that the chunk exists in
@@ -166,37 +690,102 @@ class Chunk:
         Width of this chunk
     height: int
         height of this chunk
+    cell_size: int
+        Width and height of a spatial hash cell
     """
 
-    def __init__(self, world: World, x: int, y: int, width: int, height: int):
+    def __init__(self, world: World, x: int, y: int, width: int, height: int,
+                 cell_size: int = 50):
         self.world = world
         self.x = x
         self.y = y
         self.width = width
         self.height = height
-        self.clients = []
+        self.cell_size = cell_size
+        self.clients = {}
+        self.cells = {}
+        self.moving = set()
 
     def add_client(self, client):
         """Adds a client to this chunk
         client: Client
             Client to add
         """
-        self.clients.append(client)
-        client.chunk = [self.x, self.y]
+        client.chunk_x = self.x
+        client.chunk_y = self.y
+        key = self.cell_of(client.x, client.y)
+        self.clients[client] = key
+        self.cells.setdefault(key, set()).add(client)
+        self.update_moving(client)
 
     def remove_client(self, client):
         """Removes a client from this chunk
-        could be more efficient
         client: Client
             Client to remove
         """
-        if client in self.clients:
-            self.clients.pop(self.clients.index(client))
+        key = self.clients.pop(client, None)
+        if key is not None:
+            self.discard_from_cell(client, key)
+        if client in self.moving:
+            self.moving.discard(client)
+            if not self.moving:
+                self.world.active_chunks.discard(self)
 
-    def update_clients(self):
-        """Attempts to update all clients within this chunk"""
-        for c in self.clients:
-            self.update_client(c)
+    def update_moving(self, client):
+        """Tracks whether a client in this chunk is moving
+        Adds or removes this chunk from the world's active chunks as needed
+        """
+        if client.moving and client in self.clients:
+            self.moving.add(client)
+            self.world.active_chunks.add(self)
+        elif client in self.moving:
+            self.moving.discard(client)
+            if not self.moving:
+                self.world.active_chunks.discard(self)
+
+    def cell_of(self, x, y):
+        """Returns the spatial hash cell holding a chunk local position
+        """
+        return (int(x) // self.cell_size, int(y) // self.cell_size)
+
+    def discard_from_cell(self, client, key):
+        """Removes a client from a spatial hash cell, dropping empty cells
+        """
+        cell = self.cells.get(key)
+        if cell is not None:
+            cell.discard(client)
+            if not cell:
+                del self.cells[key]
+
+    def reindex(self, client):
+        """Moves a client to the cell matching its current position
+        """
+        old = self.clients.get(client)
+        if old is None:
+            return
+        key = self.cell_of(client.x, client.y)
+        if key != old:
+            self.discard_from_cell(client, old)
+            self.cells.setdefault(key, set()).add(client)
+            self.clients[client] = key
+
+    def query_rect(self, x0, y0, x1, y1, out: list):
+        """Appends the clients whose cells overlap a chunk local rectangle to out
+        Callers filter by exact position
+        """
+        size = self.cell_size
+        (cx0, cy0, cx1, cy1) = (int(x0) // size, int(y0) // size,
+                                int(x1) // size, int(y1) // size)
+        if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) > len(self.cells):
+            for (key, cell) in self.cells.items():
+                if cx0 <= key[0] <= cx1 and cy0 <= key[1] <= cy1:
+                    out.extend(cell)
+            return
+        for cy in range(cy0, cy1 + 1):
+            for cx in range(cx0, cx1 + 1):
+                cell = self.cells.get((cx, cy))
+                if cell:
+                    out.extend(cell)
 
     def update_client(self, c):
         """Updates the positioning of the specified client
@@ -204,27 +793,32 @@ class Chunk:
         c: Client
             Client to update
         """
-        if c.vel is None or (c.vel[0] == 0 and c.vel[1] == 0):
+        if c.vel_x == 0 and c.vel_y == 0:
             return
-        # Holds the original x position of the client
-        hold_x = int(c.pos[0] + c.vel[0] * self.world.delta)
-        # Holds the original y position of the client
-        hold_y = int(c.pos[1] + c.vel[1] * self.world.delta)
-        # Clamps the x position to the width of the chunk
-        next_x = int(c.pos[0] + c.vel[0] * self.world.delta) % self.width
-        # Clamps the y position to the width of the chunk
-        next_y = int(c.pos[1] + c.vel[1] * self.world.delta) % self.height
-
-        # If any of the holds don't match, client has moved.
-        if next_x != hold_x or next_y != hold_y:
-            n_x = int(hold_x // self.width)  # Gets the new chunk X
-            n_y = int(hold_y // self.height)  # Gets the new chunk Y
-            # Attempts to move the client
-            if self.world.move_client(c, self.x + n_x, self.y+n_y):
-                c.pos = [int(next_x), int(next_y)]  # Sets the client position
-            else:
-                c.pos = [max(0, min(c.pos[0] + c.vel[0], self.width)),
-                         max(0, min(c.pos[1] + c.vel[1], self.height))]
-        else:
-            c.pos = [int(hold_x), int(hold_y)]
-            self.world.move_client(c, self.x, self.y)
+        # Holds the new x position of the client relative to this chunk
+        hold_x = c.x + c.vel_x
+        # Holds the new y position of the client relative to this chunk
+        hold_y = c.y + c.vel_y
+        n_x = int(hold_x // self.width)  # Gets the chunk X offset
+        n_y = int(hold_y // self.height)  # Gets the chunk Y offset
+
+        # Stops movement along an axis that would leave the world, the velocity
+        # change makes the next position update carry the stop to clients
+        if not 0 <= self.x + n_x < self.world.width:
+            hold_x = max(0.0, min(hold_x, self.width - 1.0))
+            n_x = 0
+            c.vel_x = 0
+        if not 0 <= self.y + n_y < self.world.height:
+            hold_y = max(0.0, min(hold_y, self.height - 1.0))
+            n_y = 0
+            c.vel_y = 0
+
+        self.world.move_client(c, self.x + n_x, self.y + n_y)
+        c.x = hold_x % self.width  # Sets the client position
+        c.y = hold_y % self.height
+        if c.vel_x == 0 and c.vel_y == 0:
+            c.moving = False
+        chunk = self.world.clients.get(c)
+        if chunk is not None:
+            chunk.update_moving(c)
+            chunk.reindex(c)